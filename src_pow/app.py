@@ -1,8 +1,13 @@
 from argparse import ArgumentParser
+from chain_cache import join_json_blocks
+import compact_block
 import config
-from flask import Flask, jsonify, request
+import encoding
+from flask import Flask, Response, jsonify, request
+import hashlib
+import json
+from mempool import POOL_FULL
 from node import Node
-import requests
 import utility
 
 
@@ -17,7 +22,8 @@ app = Flask(__name__)
 def get_node_availability():
     host_port = node.get_socket()
     response = {
-        'message': f'Node on http://{host_port} is available!'
+        'message': f'Node on http://{host_port} is available!',
+        'wire_formats': node.get_wire_formats()
     }
     return jsonify(response), 200
 
@@ -39,7 +45,7 @@ def init_node_from_peer():
         return jsonify(response), 400
 
     try:
-        response = requests.post(url=f'http://{peer}/peer/new', json={'peer': node.get_socket()} ,timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+        response = node.fanout.post(peer, '/peer/new', {'peer': node.get_socket()})
         if response.status_code == 201:
             node.peers.add(peer)
             if node.clone_from_peer(peer):
@@ -55,7 +61,9 @@ def init_node_from_peer():
         return jsonify(response), 400
 
 
-# Return all node data
+# Return all node data, ?blockchain=false leaves out the blockchain
+# (it is synchronized in pages from /blockchain/headers and /blockchain/blocks).
+# ETag: hash of the tip and of the other data
 @app.route('/node/clone', methods=['GET'])
 def get_node_replica():
     host_port = node.get_socket()
@@ -63,16 +71,61 @@ def get_node_replica():
     users = node.get_users()
     transaction_pool = node.get_transaction_pool()
     user_balence_pool = node.get_user_balence_pool()
-    blockchain = node.get_full_chain()
     response = {
         'host_port': host_port,
         'peers': peers,
         'users': users,
         'transaction_pool': transaction_pool,
-        'user_balence_pool': user_balence_pool,
-        'blockchain': blockchain
+        'user_balence_pool': user_balence_pool
     }
-    return jsonify(response), 200
+    data = json.dumps(response, sort_keys=True, separators=(',', ':')).encode()
+    etag = hashlib.sha256(data).hexdigest()[ : 16]
+    with_blockchain = utility.str2bool(request.args.get('blockchain', default='true'))
+    if with_blockchain:
+        chain, tip_hash = node.get_chain_snapshot()
+        etag = f'{tip_hash}-{etag}'
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    if with_blockchain:
+        data = b'{"blockchain":%s,%s' % (node.json_chain_cache.get_body(chain, tip_hash), data[1 : ])
+    return encoded_response(data, etag)
+
+
+# Responses holding the chain are built from the serialization cache of the node
+# and tagged with the hash of the tip, a request with a matching If-None-Match gets 304
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def encoded_response(data, etag, mimetype='application/json'):
+    response = Response(data, status=200, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+# Synchronizing the blockchain from a peer node, resuming from the local tip
+@app.route('/node/sync', methods=['POST'])
+def sync_node_from_peer():
+    body = request.get_json()
+    if body is None or body.get('peer') is None:
+        response = {
+            'error': 'Invalid request body'
+        }
+        return jsonify(response), 400
+    peer = body.get('peer')
+    if node.sync_from_peer(peer):
+        response = {
+            'message': f'Synchronized blockchain from http://{peer}',
+            'length': len(node.get_full_chain())
+        }
+        return jsonify(response), 200
+    else:
+        response = {
+            'error': f'Failed to synchronize blockchain from http://{peer}',
+            'length': len(node.get_full_chain())
+        }
+        return jsonify(response), 400
 
 
 
@@ -221,7 +274,7 @@ def get_user_balence():
         }
         return jsonify(response), 401
 
-    balence_from_blockchain = node.get_committed_user_balences().get(user)
+    balence_from_blockchain = node.get_committed_user_balence(user)
     balence_from_pool = node.get_user_balence_pool().get(user)
     response = {
         'balence_from_blockchain': balence_from_blockchain,
@@ -269,58 +322,114 @@ def get_uncommitted_transactions():
 @app.route('/transaction/new', methods=['POST'])
 def post_user_transaction():
     body = request.get_json()
-    if body is None: 
-        response = {
-            'error': 'Invalid request body'
-        }
-        return jsonify(response), 400
-    required_fields = ['sender', 'authentication','recipient', 'amount']
-    for k in required_fields:
-        if body.get(k) is None:
-            response = {
-                'error': 'Invalid request body'
-            }
-            return jsonify(response), 400
+    error = check_payment(body)
+    if error is not None:
+        response, code = error
+        return jsonify(response), code
 
     sender = body.get('sender')
-    authentication = body.get('authentication')
     recipient = body.get('recipient')
-    amount = body.get('amount')
-    if not node.authenticate_user(user=sender, password=authentication):
+    transaction, error = node.start_transaction(sender=sender, recipient=recipient, amount=body.get('amount'))
+    if transaction is None:
         response = {
-            'error': 'Sender authentication failed'
+            'error': error
         }
-        return jsonify(response), 401
-    if sender == recipient or amount<=0: 
+        return jsonify(response), payment_error_code(error)
+    else:
         response = {
-            'error': 'Illigial transaction'
+            'message': 'Your transaction will be added to Blockchain!',
+            'transaction': transaction
         }
-        return jsonify(response), 400
+        return jsonify(response), 201
 
-    transaction = node.start_transaction(sender=sender, recipient=recipient, amount=body.get('amount'))
-    if transaction is None:
+
+# Many payments in one request: {"transactions": [{sender, authentication, recipient, amount}, ...]}.
+# Payments are checked in order against the balence pool, so a payment can spend
+# what an earlier one of the batch received. The results are listed per payment
+# and the accepted transactions are broadcast together. The status is 201 if all
+# payments are accepted, 207 if only some are and 400 if none is
+@app.route('/transaction/batch', methods=['POST'])
+def post_user_transaction_batch():
+    body = request.get_json()
+    if body is None or not isinstance(body.get('transactions'), list):
         response = {
-            'error': 'No enough balence or invalid recipient'
+            'error': 'Invalid request body'
         }
         return jsonify(response), 400
-    else:
+    if len(body.get('transactions')) > config.MAX_TRANSACTIONS_PER_BATCH:
         response = {
-            'message': 'Your transaction will be added to Blockchain!',
-            'transaction': transaction
+            'error': f'At most {config.MAX_TRANSACTIONS_PER_BATCH} transactions per batch'
         }
-        return jsonify(response), 201
+        return jsonify(response), 400
+
+    results = []
+    accepted = []
+    for payment in body.get('transactions'):
+        error = check_payment(payment)
+        if error is None:
+            transaction, error = node.add_payment(payment.get('sender'), payment.get('recipient'), payment.get('amount'))
+            if transaction is None:
+                error = { 'error': error }, payment_error_code(error)
+        if error is not None:
+            response, code = error
+            results.append(dict(response, status=code))
+        else:
+            accepted.append(transaction)
+            results.append({ 'status': 201, 'transaction': transaction })
+    node.broadcast_transactions(accepted)
+    response = {
+        'message': f'{len(accepted)} of {len(results)} transactions will be added to Blockchain!',
+        'results': results
+    }
+    if len(accepted) == 0 and len(results) > 0:
+        return jsonify(response), 400
+    if len(accepted) < len(results):
+        return jsonify(response), 207
+    return jsonify(response), 201
+
+
+# Returns the error response and status code of an invalid payment, None if valid
+def check_payment(payment):
+    if not isinstance(payment, dict):
+        return { 'error': 'Invalid request body' }, 400
+    required_fields = ['sender', 'authentication','recipient', 'amount']
+    for k in required_fields:
+        if payment.get(k) is None:
+            return { 'error': 'Invalid request body' }, 400
+
+    sender = payment.get('sender')
+    authentication = payment.get('authentication')
+    recipient = payment.get('recipient')
+    amount = payment.get('amount')
+    if not node.authenticate_user(user=sender, password=authentication):
+        return { 'error': 'Sender authentication failed' }, 401
+    if sender == recipient or not isinstance(amount, (int, float)) or amount<=0:
+        return { 'error': 'Illigial transaction' }, 400
+    return None
+
+
+# A full transaction pool is a temporary condition, the payment can be retried later
+def payment_error_code(error):
+    return 503 if error == POOL_FULL else 400
 
 
 # For broadcast a transaction, notifying all peers to add this transaction
+# (or the list of transactions of a batch)
 @app.route('/transaction/add', methods=['POST'])
 def add_new_transaction():
     body = request.get_json()
-    if body is None or body.get('transaction') is None:
+    if body is None or (body.get('transaction') is None and not isinstance(body.get('transactions'), list)):
         response = {
             'error': 'Invalid request body'
         }
         return jsonify(response), 400
-    if node.add_transaction(transaction=body.get('transaction')):
+    if body.get('transactions') is not None:
+        added = node.add_transactions(transactions=body.get('transactions'), peer=body.get('peer'))
+        response = {
+            'message': f'Added {len(added)} of {len(body.get("transactions"))} transactions'
+        }
+        return jsonify(response), 201
+    if node.add_transaction(transaction=body.get('transaction'), peer=body.get('peer')):
         response = {
             'message': 'Added this transaction successfully!'
         }
@@ -332,6 +441,59 @@ def add_new_transaction():
         return jsonify(response), 201
 
 
+# Announcement of transaction ids by a peer {transaction_ids, peer},
+# the ids this node does not hold are requested from the peer
+@app.route('/transaction/inv', methods=['POST'])
+def add_transaction_inventory():
+    body = request.get_json()
+    error = check_inventory(body)
+    if error is not None:
+        return jsonify(error), 400
+    wanted = node.add_inventory(transaction_ids=body.get('transaction_ids'), peer=body.get('peer'))
+    response = {
+        'message': f'Requesting {len(wanted)} of {len(body.get("transaction_ids"))} transactions'
+    }
+    return jsonify(response), 201
+
+
+# Request of transactions by a peer {transaction_ids, peer}, the pooled ones
+# are sent to /transaction/add of the peer
+@app.route('/transaction/getdata', methods=['POST'])
+def get_transaction_data():
+    body = request.get_json()
+    error = check_inventory(body)
+    if error is not None:
+        return jsonify(error), 400
+    transactions = node.send_transactions(transaction_ids=body.get('transaction_ids'), peer=body.get('peer'))
+    response = {
+        'message': f'Sending {len(transactions)} of {len(body.get("transaction_ids"))} transactions'
+    }
+    return jsonify(response), 201
+
+
+# Returns the error response of an invalid inventory message, None if valid
+def check_inventory(body):
+    if body is None or body.get('peer') is None or not isinstance(body.get('transaction_ids'), list):
+        return { 'error': 'Invalid request body' }
+    if len(body.get('transaction_ids')) > config.INVENTORY_MAX_BATCH:
+        return { 'error': f'At most {config.INVENTORY_MAX_BATCH} transaction ids per message' }
+    if not all(isinstance(transaction_id, str) for transaction_id in body.get('transaction_ids')):
+        return { 'error': 'Invalid transaction ids' }
+    return None
+
+
+# Merkle inclusion proof of a committed transaction against the header of its block
+@app.route('/transaction/proof/<transaction_id>', methods=['GET'])
+def get_transaction_proof(transaction_id):
+    proof = node.get_transaction_proof(transaction_id)
+    if proof is None:
+        response = {
+            'error': 'Transaction not committed'
+        }
+        return jsonify(response), 404
+    return jsonify(proof), 200
+
+
 
 ###################
 # Blockchain APIs
@@ -340,12 +502,12 @@ def add_new_transaction():
 # List the full blockchain
 @app.route('/blockchain/chain', methods=['GET'])
 def get_full_blockchain():
-    blockchain = node.get_full_chain()
-    response = {
-        'blockchain': blockchain,
-        'length': len(blockchain)
-    }
-    return jsonify(response), 200
+    chain, tip_hash = node.get_chain_snapshot()
+    etag = f'{tip_hash}-json'
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    blockchain = node.json_chain_cache.get_body(chain, tip_hash)
+    return encoded_response(b'{"blockchain":%s,"length":%d}' % (blockchain, len(chain)), etag)
 
 
 # List the last adde block from blockchain
@@ -358,7 +520,8 @@ def get_last_block_blockchain():
     return jsonify(response), 200
 
 
-# A user can mine a new block and commit transactions
+# A user can mine a new block and commit transactions.
+# Mining runs as a background job, the job id is returned right away
 @app.route('/blockchain/mine', methods=['POST'])
 def mine_new_block():
     body = request.get_json()
@@ -375,20 +538,98 @@ def mine_new_block():
         }
         return jsonify(response), 401
 
-    new_block = node.mine(user)
+    job = node.start_mining_job(user)
+    response = {
+        'message': 'Mining job started',
+        'job_id': job.get('job_id'),
+        'job': job
+    }
+    return jsonify(response), 202
 
-    if new_block is None:
+
+# Poll a mining job, ?wait=<seconds> long-polls until the job is finished
+@app.route('/blockchain/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    wait = request.args.get('wait', default=0, type=float)
+    if wait > 0:
+        job = node.wait_mining_job(job_id, min(wait, config.MINING_JOB_MAX_WAIT_IN_SECONDS))
+    else:
+        job = node.get_mining_job(job_id)
+    if job is None:
         response = {
-            'error': 'Mining aborted'
+            'error': 'Mining job not found'
         }
-        return jsonify(response), 500
+        return jsonify(response), 404
+
+    response = {
+        'job': job
+    }
+    if job.get('status') == 'done':
+        response['message'] = 'New block forged'
+        response['mining_reward'] = config.MINING_REWARD
+        response['new_block'] = job.get('new_block')
+    return jsonify(response), 200
+
+
+# Cancel a queued or running mining job
+@app.route('/blockchain/mine/<job_id>', methods=['DELETE'])
+def cancel_mining_job(job_id):
+    if node.cancel_mining_job(job_id):
+        response = {
+            'message': 'Mining job cancelled'
+        }
+        return jsonify(response), 200
     else:
         response = {
-            'message': 'New block forged',
-            'mining_reward': config.MINING_REWARD,
-            'new_block': new_block
+            'error': 'Mining job not found or already finished'
         }
-        return jsonify(response), 201
+        return jsonify(response), 404
+
+
+# Work for an external mining worker: the header of a block template rewarding
+# the user and a nonce range [nonce_start, nonce_end) given to this worker only
+@app.route('/mining/template', methods=['POST'])
+def get_mining_template():
+    body = request.get_json()
+    if body is None or body.get('username') is None or body.get('password') is None:
+        response = {
+            'error': 'Invalid request body'
+        }
+        return jsonify(response), 400
+    user = body.get('username')
+    password = body.get('password')
+    if not node.authenticate_user(user=user, password=password):
+        response = {
+            'error': 'User authentication failed'
+        }
+        return jsonify(response), 401
+
+    response = node.get_mining_work(user)
+    return jsonify(response), 200
+
+
+# A worker submits the nonce it found for a template, the block is then published
+@app.route('/mining/submit', methods=['POST'])
+def submit_mining_work():
+    body = request.get_json()
+    if body is None or body.get('template_id') is None or body.get('nonce') is None:
+        response = {
+            'error': 'Invalid request body'
+        }
+        return jsonify(response), 400
+
+    new_block, error = node.submit_mining_work(body.get('template_id'), body.get('nonce'))
+    if new_block is None:
+        response = {
+            'error': error
+        }
+        return jsonify(response), 400
+    response = {
+        'message': 'New block forged',
+        'mining_reward': config.MINING_REWARD,
+        'new_block': new_block
+    }
+    return jsonify(response), 201
 
 
 # For broadcast a new block, notifying all peers about blockchain changes
@@ -413,15 +654,129 @@ def add_new_blockchain():
         return jsonify(response), 201
 
 
+# Return a single block of the blockchain by its index
+# (as stored in the block store of the node, without encoding it again)
+@app.route('/blockchain/block/<int:index>', methods=['GET'])
+def get_block_blockchain(index):
+    data = node.get_encoded_block(index)
+    if data is None:
+        response = {
+            'error': 'Block not found'
+        }
+        return jsonify(response), 404
+    return Response(b'{"block":%s}' % data, status=200, mimetype='application/json')
+
+
+# Transactions of a block by its hash: ?hash=<block hash>&indexes=<i,j,...>,
+# pulled by peers rebuilding a compact block
+@app.route('/blockchain/block/transactions', methods=['GET'])
+def get_block_transactions():
+    try:
+        indexes = [int(index) for index in request.args.get('indexes', default='').split(',') if index != '']
+    except ValueError:
+        indexes = None
+    if request.args.get('hash') is None or indexes is None:
+        response = {
+            'error': 'Invalid request parameters'
+        }
+        return jsonify(response), 400
+    transactions = node.get_block_transactions_by_hash(request.args.get('hash'), indexes)
+    if transactions is None:
+        response = {
+            'error': 'Block or transactions not found'
+        }
+        return jsonify(response), 404
+    response = {
+        'transactions': transactions
+    }
+    return jsonify(response), 200
+
+
+# For broadcast a new block, notifying all peers about the new block only.
+# Missing ancestors are pulled from the announcing peer
+# The block is either JSON {block, peer}, a compact block {compact_block, peer}
+# or binary encoded with ?peer=<host:port>
+@app.route('/blockchain/block', methods=['POST'])
+def add_new_block():
+    if request.mimetype == encoding.MIME_TYPE:
+        data = request.get_data()
+        try:
+            block, end = encoding.decode_block(data)
+        except ValueError:
+            block, end = None, None
+        body = { 'block': block if end == len(data) else None, 'peer': request.args.get('peer') }
+    else:
+        body = request.get_json()
+    if not isinstance(body, dict) or not isinstance(body.get('peer', ''), str):
+        response = {
+            'error': 'Invalid request body'
+        }
+        return jsonify(response), 400
+    if body.get('compact_block') is not None:
+        if not compact_block.is_compact_block(body.get('compact_block')) or body.get('peer') is None:
+            response = {
+                'error': 'Invalid request body'
+            }
+            return jsonify(response), 400
+        added = node.add_compact_block(body.get('compact_block'), body.get('peer'))
+    elif not isinstance(body.get('block'), dict):
+        response = {
+            'error': 'Invalid request body'
+        }
+        return jsonify(response), 400
+    else:
+        added = node.add_block(block=body.get('block'), peer=body.get('peer'))
+
+    if added:
+        response = {
+            'message': 'Added this block successfully!'
+        }
+        return jsonify(response), 201
+    else:
+        response = {
+            'message': 'Block not added'
+        }
+        return jsonify(response), 201
+
+
+# List block headers in pages: ?from=<index>&count=<number of headers>
+@app.route('/blockchain/headers', methods=['GET'])
+def get_blockchain_headers():
+    start = max(request.args.get('from', default=0, type=int), 0)
+    count = min(request.args.get('count', default=config.MAX_HEADERS_PER_REQUEST, type=int), config.MAX_HEADERS_PER_REQUEST)
+    count = max(count, 0)
+    headers = node.get_headers(start, count)
+    response = {
+        'headers': headers,
+        'length': len(node.get_full_chain())
+    }
+    return jsonify(response), 200
+
+
+# List full blocks in pages: ?from=<index>&count=<number of blocks>
+# (binary encoded if the Accept header prefers the binary encoding)
+@app.route('/blockchain/blocks', methods=['GET'])
+def get_blockchain_blocks():
+    start = max(request.args.get('from', default=0, type=int), 0)
+    count = min(request.args.get('count', default=config.MAX_BLOCKS_PER_REQUEST, type=int), config.MAX_BLOCKS_PER_REQUEST)
+    count = max(count, 0)
+    if request.accept_mimetypes.best_match(['application/json', encoding.MIME_TYPE]) == encoding.MIME_TYPE:
+        return Response(encoding.encode_blocks(node.get_blocks(start, count)), status=200, mimetype=encoding.MIME_TYPE)
+    data = b'{"blocks":%s,"length":%d}' % (join_json_blocks(node.get_encoded_blocks(start, count)), len(node.get_full_chain()))
+    return Response(data, status=200, mimetype='application/json')
+
+
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
     parser.add_argument('-d', '--debug', default=True, type=utility.str2bool, help='enable flask debug mode')
+    parser.add_argument('--data-dir', default=config.BLOCK_STORE_DIR, help='directory of the persistent block store')
     args = parser.parse_args()
 
     host = '127.0.0.1' #TODO
     port = args.port
     debug = args.debug
-    node = Node(host=host, port=port)
-    app.run(host=host, port=port, debug=debug)
+    node = Node(host=host, port=port, data_dir=args.data_dir)
+    # Requests are served concurrently, the node state is guarded by its own locks
+    app.run(host=host, port=port, debug=debug, threaded=True)
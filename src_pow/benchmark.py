@@ -0,0 +1,175 @@
+from argparse import ArgumentParser
+from blockchain import Blockchain
+import config
+import encoding
+import json
+from node import Node
+import os
+import platform
+import statistics
+import sys
+from time import perf_counter, time
+
+
+# Reproducible benchmarks of the proof-of-work blockchain, results are written as JSON:
+#   python benchmark.py -o results.json
+# Difficulty retargeting is disabled while benchmarking so that every block of
+# a generated chain is mined with the requested target bits.
+
+def create_node(users=0, port=0):
+    node = Node(host='127.0.0.1', port=port)
+    for i in range(users):
+        node.add_user(f'user{i}', 'password')
+    return node
+
+def add_transactions(node, count):
+    users = list(node.get_users())
+    for i in range(count):
+        node.start_transaction(users[i % len(users)], users[(i + 1) % len(users)], 1)
+
+def median_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    return statistics.median(timings)
+
+
+# Hashes per second of Blockchain.mine for each target bits
+def benchmark_mining(target_bits_list, blocks, workers):
+    results = []
+    for target_bits in target_bits_list:
+        config.TARGET_BITS = target_bits
+        node = create_node(users=1)
+        node.blockchain.miner.workers = workers
+        attempts = 0
+        start = perf_counter()
+        for _ in range(blocks):
+            node.blockchain.mine('user0')
+            attempts += node.blockchain.miner.attempts
+        elapsed = perf_counter() - start
+        node.blockchain.miner.shutdown()
+        results.append({
+            'target_bits': target_bits,
+            'workers': workers,
+            'blocks': blocks,
+            'hashes': attempts,
+            'seconds': elapsed,
+            'hashes_per_second': attempts / elapsed
+        })
+    return results
+
+# Cost of Blockchain.hash for a block of the given number of users and transactions.
+# Only the fixed-size header is hashed, so the Merkle roots committing to the
+# body, computed once per block when it is created or verified, are timed too
+def benchmark_block_hash(user_counts, transaction_counts, repeat):
+    results = []
+    for users in user_counts:
+        for transactions in transaction_counts:
+            node = create_node(users=max(users, 2))
+            add_transactions(node, transactions)
+            block = node.blockchain.create_new_block('user0')
+            results.append({
+                'users': users,
+                'transactions': transactions,
+                'block_bytes': len(json.dumps(block, sort_keys=True)),
+                'seconds_per_hash': median_time(lambda: Blockchain.hash(block), repeat),
+                'seconds_per_transactions_root': median_time(lambda: Blockchain.transactions_root(block), repeat),
+                'seconds_per_balances_root': median_time(lambda: Blockchain.balances_root(block), repeat)
+            })
+    return results
+
+def create_chain(length, users, transactions_per_block):
+    node = create_node(users=max(users, 2))
+    node.blockchain.miner.workers = 1
+    while len(node.blockchain.get_chain()) < length:
+        add_transactions(node, transactions_per_block)
+        node.blockchain.mine('user0')
+    return node
+
+# Blocks per second of verify_chain for each chain length, in one process
+# and across verifier_workers processes
+def benchmark_verify_chain(chain_lengths, users, transactions_per_block, verifier_workers, repeat):
+    results = []
+    config.PARALLEL_VERIFICATION_MIN_BLOCKS = 0
+    for length in chain_lengths:
+        node = create_chain(length, users, transactions_per_block)
+        chain = node.get_full_chain()
+        verifier = node.blockchain.verifier
+        verifier.workers = 1
+        seconds = median_time(lambda: node.blockchain.verify_chain(chain), repeat)
+        verifier.workers = verifier_workers
+        parallel_seconds = median_time(lambda: node.blockchain.verify_chain(chain), repeat)
+        verifier.shutdown()
+        results.append({
+            'chain_length': length,
+            'seconds': seconds,
+            'blocks_per_second': length / seconds,
+            'verifier_workers': verifier_workers,
+            'parallel_seconds': parallel_seconds,
+            'parallel_blocks_per_second': length / parallel_seconds
+        })
+    return results
+
+# JSON and binary encode and decode time of the chain
+def benchmark_chain_json(chain_lengths, users, transactions_per_block, repeat):
+    results = []
+    for length in chain_lengths:
+        node = create_chain(length, users, transactions_per_block)
+        chain = node.get_full_chain()
+        response = { 'blockchain': chain, 'length': len(chain) }
+        encoded = json.dumps(response)
+        binary = encoding.encode_blocks(chain)
+        results.append({
+            'chain_length': length,
+            'bytes': len(encoded),
+            'encode_seconds': median_time(lambda: json.dumps(response), repeat),
+            'decode_seconds': median_time(lambda: json.loads(encoded), repeat),
+            'binary_bytes': len(binary),
+            'binary_encode_seconds': median_time(lambda: encoding.encode_blocks(chain), repeat),
+            'binary_decode_seconds': median_time(lambda: encoding.decode_blocks(binary), repeat)
+        })
+    return results
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(',')]
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--output', default=None, help='JSON result file (default: stdout)')
+    parser.add_argument('--target-bits', default='8,12,16', type=parse_int_list, help='target bits for the mining benchmark')
+    parser.add_argument('--mined-blocks', default=3, type=int, help='blocks mined per target bits')
+    parser.add_argument('--workers', default=config.MINING_WORKERS, type=int, help='mining worker processes')
+    parser.add_argument('--users', default='10,100,1000,10000', type=parse_int_list, help='user counts for the hash benchmark')
+    parser.add_argument('--transactions', default='0,10,100,1000', type=parse_int_list, help='transaction counts for the hash benchmark')
+    parser.add_argument('--chain-lengths', default='10,100,1000', type=parse_int_list, help='chain lengths for the verification and JSON benchmarks')
+    parser.add_argument('--chain-users', default=100, type=int, help='users of the generated chains')
+    parser.add_argument('--chain-transactions', default=10, type=int, help='transactions per block of the generated chains')
+    parser.add_argument('--verifier-workers', default=config.VERIFIER_WORKERS, type=int, help='verifier processes for the parallel verification benchmark')
+    parser.add_argument('--chain-target-bits', default=4, type=int, help='target bits of the generated chains')
+    parser.add_argument('--repeat', default=5, type=int, help='repetitions of each timing (the median is reported)')
+    args = parser.parse_args()
+
+    config.RETARGET_INTERVAL_IN_BLOCKS = sys.maxsize
+    config.MEMPOOL_EXPIRY_IN_SECONDS = sys.maxsize
+    results = {
+        'timestamp': int(time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'mining': benchmark_mining(args.target_bits, args.mined_blocks, args.workers),
+        'block_hash': benchmark_block_hash(args.users, args.transactions, args.repeat)
+    }
+    config.TARGET_BITS = args.chain_target_bits
+    results['verify_chain'] = benchmark_verify_chain(args.chain_lengths, args.chain_users, args.chain_transactions,
+                                                     args.verifier_workers, args.repeat)
+    results['chain_json'] = benchmark_chain_json(args.chain_lengths, args.chain_users, args.chain_transactions, args.repeat)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
@@ -0,0 +1,186 @@
+import config
+import json
+import mmap
+import os
+import struct
+import threading
+
+
+# Append-only block store on disk: blocks.log holds the JSON encoded blocks
+# one after another, blocks.index holds a fixed-width (offset, length, hash, target)
+# entry per block. The index is memory-mapped, so a block is found by height
+# in O(1), and the block hashes and the work of the chain are recovered after
+# a restart without reading the blocks. Blocks are served to peers as stored,
+# without encoding them again. Registered users are kept beside the blocks in users.json
+class BlockStore(object):
+    INDEX_ENTRY = struct.Struct('>QQ32s32s')
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.users_path = os.path.join(directory, 'users.json')
+        self.log_file = open(os.path.join(directory, 'blocks.log'), 'a+b')
+        self.index_file = open(os.path.join(directory, 'blocks.index'), 'a+b')
+        self.index = None
+        self.index_outdated = True
+        self.height = 0
+        self.lock = threading.RLock()
+        self.recover()
+
+    def __len__(self):
+        return self.height
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+        self.log_file.close()
+        self.index_file.close()
+
+
+    # Dropping a partially written tail left by a crash: incomplete index entries,
+    # entries pointing past the end of the log and log bytes without index entry
+    def recover(self):
+        index_size = os.fstat(self.index_file.fileno()).st_size
+        log_size = os.fstat(self.log_file.fileno()).st_size
+        self.height = index_size // self.INDEX_ENTRY.size
+        while self.height > 0:
+            offset, length = self.read_index_entry(self.height - 1)[ : 2]
+            if offset + length <= log_size:
+                break
+            self.height -= 1
+        log_end = sum(self.read_index_entry(self.height - 1)[ : 2]) if self.height > 0 else 0
+        self.truncate_files(self.height, log_end)
+
+    def read_index_entry(self, height):
+        if self.index_outdated:
+            if self.index is not None:
+                self.index.close()
+            index_size = os.fstat(self.index_file.fileno()).st_size
+            self.index = mmap.mmap(self.index_file.fileno(), index_size, access=mmap.ACCESS_READ) if index_size > 0 else None
+            self.index_outdated = False
+        return self.INDEX_ENTRY.unpack_from(self.index, height * self.INDEX_ENTRY.size)
+
+    def truncate_files(self, height, log_end):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        self.index_file.truncate(height * self.INDEX_ENTRY.size)
+        self.log_file.truncate(log_end)
+        self.index_outdated = True
+        self.height = height
+
+
+    # JSON encoded block at height, None if there is none
+    def get_block_data(self, height):
+        with self.lock:
+            if height < 0:
+                height += self.height
+            if not 0 <= height < self.height:
+                return None
+            offset, length = self.read_index_entry(height)[ : 2]
+            return os.pread(self.log_file.fileno(), length, offset)
+
+    # JSON encoded blocks from start on (at most count), read together so that
+    # they belong to the same chain
+    def get_blocks_data(self, start, count):
+        with self.lock:
+            return [self.get_block_data(height) for height in range(max(start, 0), min(start + count, self.height))]
+
+    def get_block(self, height):
+        data = self.get_block_data(height)
+        return json.loads(data) if data is not None else None
+
+    def get_blocks(self, start=0):
+        for height in range(start, self.height):
+            yield self.get_block(height)
+
+    def get_block_hashes(self):
+        with self.lock:
+            return [self.read_index_entry(height)[2].hex() for height in range(self.height)]
+
+    def get_block_targets(self):
+        with self.lock:
+            return [self.read_index_entry(height)[3].hex() for height in range(self.height)]
+
+    def append(self, block, block_hash):
+        data = json.dumps(block, sort_keys=True).encode()
+        with self.lock:
+            offset = os.fstat(self.log_file.fileno()).st_size
+            self.log_file.write(data)
+            self.log_file.flush()
+            self.index_file.write(self.INDEX_ENTRY.pack(offset, len(data), bytes.fromhex(block_hash),
+                                                        bytes.fromhex(block.get('target'))))
+            self.index_file.flush()
+            if config.BLOCK_STORE_FSYNC:
+                os.fsync(self.log_file.fileno())
+                os.fsync(self.index_file.fileno())
+            self.index_outdated = True
+            self.height += 1
+
+    # Removing all blocks from height onwards (chain reorganization)
+    def truncate(self, height):
+        with self.lock:
+            if height >= self.height:
+                return
+            log_end = self.read_index_entry(height)[0]
+            self.truncate_files(height, log_end)
+
+
+    def load_users(self):
+        if not os.path.exists(self.users_path):
+            return dict()
+        with open(self.users_path) as f:
+            return json.load(f)
+
+    def save_users(self, users):
+        temporary_path = self.users_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(users, f)
+        os.replace(temporary_path, self.users_path)
+
+
+# Chain recovered from the block store: the first length blocks are read from
+# the log when accessed, the blocks appended afterwards are kept in memory. Like
+# the chain list it is never modified in place, appending builds a new chain
+# sharing the stored blocks. Stored blocks are pinned in memory before a reorg
+# drops them from the store, so that older chains stay consistent snapshots
+class StoredChain(object):
+    def __init__(self, store, length, blocks=None, pinned=None):
+        self.store = store
+        self.length = length
+        self.blocks = blocks if blocks is not None else []
+        self.pinned = pinned if pinned is not None else dict()
+
+    def __len__(self):
+        return self.length + len(self.blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('chain index out of range')
+        if index >= self.length:
+            return self.blocks[index - self.length]
+        block = self.pinned.get(index)
+        return block if block is not None else self.store.get_block(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __add__(self, blocks):
+        return StoredChain(self.store, self.length, self.blocks + list(blocks), self.pinned)
+
+    # The first length blocks as a new chain, without reading the stored ones
+    def head(self, length):
+        if length >= self.length:
+            return StoredChain(self.store, self.length, self.blocks[ : length - self.length], self.pinned)
+        pinned = { index: block for index, block in self.pinned.items() if index < length }
+        return StoredChain(self.store, length, [], pinned)
+
+    # Keeping the stored blocks from height on in memory, before the store drops them
+    def pin(self, height):
+        for index in range(max(height, 0), self.length):
+            if index not in self.pinned:
+                self.pinned[index] = self.store.get_block(index)
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import config
+from miner import decode_target
+
+
+# Expected number of hashes to find a block with the target of the block
+def get_block_work(block):
+    return get_target_work(block.get('target'))
+
+def get_target_work(target):
+    return 2 ** 256 // (decode_target(target) + 1)
+
+
+# Tree of all known valid blocks keyed by hash, the main chain and the side
+# branches that may still overtake it. Each entry records the height of the
+# block and the cumulative work of the chain ending with it. Blocks whose
+# parent is unknown wait in a bounded orphan pool until the parent arrives.
+class BlockTree(object):
+    def __init__(self):
+        self.entries = dict()
+        self.heights = dict()
+        self.pruned_height = 0
+        self.orphans = OrderedDict()
+        self.orphans_by_parent = dict()
+
+    def __contains__(self, block_hash):
+        return block_hash in self.entries
+
+    def get(self, block_hash):
+        return self.entries.get(block_hash)
+
+    def get_work(self, block_hash):
+        return self.entries[block_hash].get('work')
+
+    def clear(self):
+        self.entries.clear()
+        self.heights.clear()
+        self.pruned_height = 0
+
+    # The parent of the block must be in the tree, unless it is a genesis block
+    def add(self, block, block_hash):
+        return self.add_entry(block_hash, block.get('previous_block_hash'), block.get('target'), block)
+
+    # A block recovered from the block store is added by its hash and target only,
+    # the block itself is filled in if it is added again
+    def add_entry(self, block_hash, parent_hash, target, block=None):
+        if block_hash in self.entries:
+            entry = self.entries[block_hash]
+            if entry.get('block') is None:
+                entry['block'] = block
+            return entry
+        parent = self.entries.get(parent_hash)
+        entry = {
+            'block': block,
+            'height': parent.get('height') + 1 if parent is not None else 0,
+            'work': (parent.get('work') if parent is not None else 0) + get_target_work(target)
+        }
+        self.entries[block_hash] = entry
+        self.heights.setdefault(entry.get('height'), set()).add(block_hash)
+        return entry
+
+    # Dropping the side branches below min_height, they can no longer overtake
+    # the main chain. get_main_hash(height) is the hash of the main chain block
+    def prune(self, min_height, get_main_hash):
+        for height in range(self.pruned_height, min_height):
+            main_hash = get_main_hash(height)
+            for block_hash in self.heights.get(height, set()) - { main_hash }:
+                del self.entries[block_hash]
+            self.heights[height] = { main_hash }
+        self.pruned_height = max(self.pruned_height, min_height)
+
+
+    def is_orphan(self, block_hash):
+        return block_hash in self.orphans
+
+    def add_orphan(self, block, block_hash):
+        if block_hash in self.orphans:
+            return
+        self.orphans[block_hash] = block
+        self.orphans_by_parent.setdefault(block.get('previous_block_hash'), []).append(block_hash)
+        while len(self.orphans) > config.ORPHAN_POOL_CAPACITY:
+            self.remove_orphan(next(iter(self.orphans)))
+
+    def remove_orphan(self, block_hash):
+        block = self.orphans.pop(block_hash)
+        siblings = self.orphans_by_parent.get(block.get('previous_block_hash'))
+        siblings.remove(block_hash)
+        if len(siblings) == 0:
+            del self.orphans_by_parent[block.get('previous_block_hash')]
+        return block
+
+    # Removes and returns the orphans waiting for the block as (block, hash) pairs
+    def pop_orphans(self, parent_hash):
+        return [(self.remove_orphan(block_hash), block_hash)
+                for block_hash in list(self.orphans_by_parent.get(parent_hash, []))]
@@ -1,18 +1,57 @@
+from block_store import StoredChain
+from block_tree import BlockTree, get_block_work
 import config
+from encoding import encode_header
 import hashlib
-import json
+from merkle import merkle_proof, merkle_root
+from miner import MAX_TARGET, Miner, decode_target, encode_target, is_valid_hash, target_from_bits
+import threading
 from time import time
 from uuid import uuid4
+from verifier import ChainVerifier
 
 
 # Bitcoin-liked blockchain implementation 
-# using the Proof-of-Work consensus algorithm
+# using the Proof-of-Work consensus algorithm.
+# A block is a fixed-size header committing to its body through Merkle roots,
+# only the header is hashed for mining and verification.
+# Concurrency: the chain tip is changed under the chain lock only. The chain list
+# and the committed balences are never modified in place: a new block or a reorg
+# builds a new list and new balences and publishes each with one assignment, so a
+# reference to the chain or to the balences is a consistent snapshot. Block hashes
+# are memoized by index of the current chain, readers needing the chain together
+# with its hashes take the lock.
+# Fork choice: all known valid blocks form a tree keyed by hash, the chain is the
+# branch of the tree with the most cumulative work.
 class Blockchain(object):
+    HEADER_FIELDS = ( 'index', 'previous_block_hash', 'timestamp', 'nonce', 'target',
+                      'merkle_root', 'balances_root' )
+    BODY_FIELDS = { 'transactions', 'user_balences', 'balance_deltas' }
+
     def __init__(self, node):
         self.node = node
         self.chain = []
-        genesis_block = self.create_new_block()
-        self.chain.append(genesis_block)
+        # Memoized block hashes keyed by block index, invalidated on set_chain
+        self.block_hashes = dict()
+        # Account-state index: committed balences at the tip of the chain
+        self.balences = dict()
+        self.miner = Miner(config.MINING_WORKERS)
+        self.verifier = ChainVerifier(config.VERIFIER_WORKERS)
+        self.tip_listeners = []
+        self.lock = threading.RLock()
+        self.tree = BlockTree()
+        # Recovering the chain from the block store of the node if any: the hashes
+        # and the tree come from the store index, the balences from the blocks since
+        # the last checkpoint, the other blocks are only read when accessed
+        self.store = self.node.block_store
+        if self.store is not None and len(self.store) > 0:
+            self.chain = StoredChain(self.store, len(self.store))
+            self.block_hashes = dict(enumerate(self.store.get_block_hashes()))
+            self.balences = self.compute_balences(self.chain, len(self.chain) - 1)
+            self.recover_tree()
+        else:
+            genesis_block = self.create_new_block()
+            self.append_block(genesis_block, self.hash(genesis_block))
 
 
     def get_chain(self):
@@ -21,52 +60,393 @@ class Blockchain(object):
     def get_last_block(self):
         return self.chain[-1];
 
+    # A block header together with its hash
+    def get_header(self, index):
+        header = self.header_of(self.chain[index])
+        header['hash'] = self.get_block_hash(index)
+        return header
+
     def get_committed_user_balences(self):
-        return self.chain[-1].get('user_balences').copy()
+        return self.balences.copy()
+
+    def get_committed_user_balence(self, user):
+        return self.balences.get(user)
+
+    def set_chain(self, chain, chain_hashes=None):
+        with self.lock:
+            self.pin_stored_blocks(0)
+            self.block_hashes = dict(enumerate(chain_hashes)) if chain_hashes is not None else dict()
+            self.balences = self.compute_balences(chain, len(chain) - 1)
+            self.chain = chain
+            self.rebuild_tree()
+            if self.store is not None:
+                self.store.truncate(0)
+                for index, block in enumerate(chain):
+                    self.store.append(block, self.get_block_hash(index))
+        self.notify_tip_change()
+
+    def get_block_hash(self, index):
+        if index < 0:
+            index += len(self.chain)
+        block_hash = self.block_hashes.get(index)
+        if block_hash is None:
+            with self.lock:
+                block_hash = self.hash(self.chain[index])
+                self.block_hashes[index] = block_hash
+        return block_hash
+
+    def get_last_block_hash(self):
+        return self.get_block_hash(len(self.chain) - 1)
+
+    # The chain and the memoized hash of its last block, as one consistent snapshot
+    # taken under the lock and bounded to the length of the chain at that time
+    def get_chain_snapshot(self):
+        with self.lock:
+            length = len(self.chain)
+            return self.get_chain_head(length), self.get_block_hash(length - 1)
+
+    # Committing a verified block together with its precomputed hash
+    def append_block(self, block, block_hash):
+        with self.lock:
+            balences = dict(self.balences)
+            self.apply_balences(balences, block)
+            self.block_hashes[len(self.chain)] = block_hash
+            self.chain = self.chain + [block]
+            self.balences = balences
+            if self.store is not None:
+                self.store.append(block, block_hash)
+            self.tree.add(block, block_hash)
+            self.prune_tree()
+
+    # Replacing all blocks from index fork onwards by a verified suffix. The new
+    # chain list is built in full before it replaces the chain.
+    # Returns the abandoned blocks
+    def splice_chain(self, fork, suffix, suffix_hashes):
+        with self.lock:
+            self.pin_stored_blocks(fork)
+            abandoned = self.chain[fork : ]
+            abandoned_hashes = [self.get_block_hash(index) for index in range(fork, len(self.chain))]
+            chain = self.get_chain_head(fork) + list(suffix)
+            block_hashes = { index: self.block_hashes[index] for index in range(fork) if index in self.block_hashes }
+            block_hashes.update(zip(range(fork, len(chain)), suffix_hashes))
+            balences = self.compute_balences(chain, len(chain) - 1)
+            self.block_hashes = block_hashes
+            self.chain = chain
+            self.balences = balences
+            if self.store is not None:
+                self.store.truncate(fork)
+                for block, block_hash in zip(suffix, suffix_hashes):
+                    self.store.append(block, block_hash)
+            if fork == 0:
+                self.tree.clear()
+            else:
+                for block, block_hash in zip(abandoned, abandoned_hashes):
+                    self.tree.add(block, block_hash)
+            for block, block_hash in zip(suffix, suffix_hashes):
+                self.tree.add(block, block_hash)
+            self.prune_tree()
+        return abandoned
 
-    def set_chain(self, chain):
-        self.chain = chain
+    # The first length blocks of the chain as a new chain, blocks of a chain
+    # recovered from the block store are not read
+    def get_chain_head(self, length):
+        if isinstance(self.chain, StoredChain):
+            return self.chain.head(length)
+        return self.chain[ : length]
 
+    # Blocks of the chain recovered from the store from height on are kept in memory
+    # before the store drops them, references to the chain stay consistent snapshots
+    def pin_stored_blocks(self, height):
+        if isinstance(self.chain, StoredChain):
+            self.chain.pin(height)
+
+    def rebuild_tree(self):
+        self.tree.clear()
+        for index, block in enumerate(self.chain):
+            self.tree.add(block, self.get_block_hash(index))
+        self.prune_tree()
+
+    # The tree of a chain recovered from the block store is built from the hashes
+    # and targets of its index, the blocks are added to the tree when read
+    def recover_tree(self):
+        self.tree.clear()
+        block_hashes = self.store.get_block_hashes()
+        for index, (block_hash, target) in enumerate(zip(block_hashes, self.store.get_block_targets())):
+            self.tree.add_entry(block_hash, block_hashes[index - 1] if index > 0 else None, target)
+        self.prune_tree()
+
+    # Side branches forking more than BLOCK_TREE_MAX_FORK_DEPTH blocks below the tip are dropped
+    def prune_tree(self):
+        min_height = len(self.chain) - config.BLOCK_TREE_MAX_FORK_DEPTH
+        if min_height > 0:
+            self.tree.prune(min_height, self.get_block_hash)
+
+    def get_tip_work(self):
+        return self.tree.get_work(self.get_last_block_hash())
+
+    # Cumulative work of the first length blocks of the chain
+    def get_chain_work(self, length):
+        return self.tree.get_work(self.get_block_hash(length - 1)) if length > 0 else 0
+
+    # Whether the block is known, connected to the tree or waiting as an orphan
+    def has_block(self, block_hash):
+        return block_hash in self.tree or self.tree.is_orphan(block_hash)
+
+    def is_orphan(self, block_hash):
+        return self.tree.is_orphan(block_hash)
+
+    # Blocks recovered from the block store are read from the chain
+    def get_block_by_hash(self, block_hash):
+        entry = self.tree.get(block_hash)
+        if entry is None:
+            return None
+        if entry.get('block') is None:
+            return self.chain[entry.get('height')]
+        return entry.get('block')
+
+    # Whether the block is on the chain (the main branch of the tree)
+    def is_main(self, block_hash):
+        entry = self.tree.get(block_hash)
+        if entry is None:
+            return False
+        height = entry.get('height')
+        chain = self.chain
+        return height < len(chain) and self.get_block_hash(height) == block_hash
 
+    # The blocks of the side branch ending with the block, from the fork point
+    # with the chain on. Returns (fork, blocks, block_hashes), None if the
+    # branch is no longer connected to the chain
+    def get_branch(self, block_hash):
+        blocks, block_hashes = [], []
+        while not self.is_main(block_hash):
+            entry = self.tree.get(block_hash)
+            if entry is None:
+                return None
+            blocks.append(entry.get('block'))
+            block_hashes.append(block_hash)
+            block_hash = entry.get('block').get('previous_block_hash')
+        blocks.reverse()
+        block_hashes.reverse()
+        return self.tree.get(block_hash).get('height') + 1, blocks, block_hashes
+
+    # Listeners are called whenever the last block of the chain changes
+    def add_tip_listener(self, listener):
+        self.tip_listeners.append(listener)
+
+    def notify_tip_change(self):
+        for listener in self.tip_listeners:
+            listener()
+
+
+    @classmethod
+    def header_of(cls, block):
+        return { k: block.get(k) for k in cls.HEADER_FIELDS }
+
+    # The hash of a block is the hash of its binary encoded header,
+    # None if the header cannot be encoded
+    @staticmethod
+    def hash(block):
+        try:
+            return hashlib.sha256(encode_header(block)).hexdigest()
+        except ValueError:
+            return None
+
+    def hash_chain(self, chain):
+        return [self.hash(block) for block in chain]
+
+    # Merkle root of the transactions of a block
+    @staticmethod
+    def transactions_root(block):
+        return merkle_root(block.get('transactions', list()))
+
+    # Merkle root of the balence checkpoint or deltas of a block, the first
+    # leaf tells which of the two the block holds
     @staticmethod
-    def hash(block):        
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+    def balances_root(block):
+        leaves = []
+        for field in ('user_balences', 'balance_deltas'):
+            if block.get(field) is not None:
+                leaves.append([field])
+                leaves += [[field, user, balence] for user, balence in sorted(block.get(field).items())]
+        return merkle_root(leaves)
+
+    # Types of the transaction fields, a number is an int or a float but not a bool
+    TRANSACTION_FIELDS = { 'transaction_id': str, 'sender': str, 'recipient': str,
+                           'amount': (int, float), 'timestamp': int }
+
+    @staticmethod
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    @classmethod
+    def is_valid_transaction(cls, transaction):
+        if not isinstance(transaction, dict):
+            return False
+        for field, field_type in cls.TRANSACTION_FIELDS.items():
+            value = transaction.get(field)
+            if not isinstance(value, field_type) or isinstance(value, bool):
+                return False
+        return True
+
+    # Balences map user names to numbers
+    @classmethod
+    def is_valid_balences(cls, balences):
+        return isinstance(balences, dict) and \
+               all(isinstance(user, str) and cls.is_number(balence) for user, balence in balences.items())
+
+    # A body is well formed and matches its header if both Merkle roots are recomputed from it
+    @classmethod
+    def verify_body(cls, block):
+        transactions = block.get('transactions')
+        if not isinstance(transactions, list) or not all(cls.is_valid_transaction(transaction) for transaction in transactions):
+            return False
+        # Merkle levels copy their last odd node, so a repeated transaction would keep the root unchanged
+        if len(set(transaction['transaction_id'] for transaction in transactions)) != len(transactions):
+            return False
+        for field in ('user_balences', 'balance_deltas'):
+            if block.get(field) is not None and not cls.is_valid_balences(block.get(field)):
+                return False
+        return block.get('merkle_root') == cls.transactions_root(block) and \
+               block.get('balances_root') == cls.balances_root(block)
+
+    # Inclusion proof of the transaction at position in the block at index
+    def get_transaction_proof(self, index, position):
+        return merkle_proof(self.chain[index].get('transactions'), position)
 
 
+    # Balences committed by a block: a full checkpoint every BALANCE_CHECKPOINT_INTERVAL
+    # blocks, otherwise only the changes since the previous block.
+    # A block holds at most MAX_BLOCK_TRANSACTIONS transactions (mining reward included)
     def create_new_block(self, miner=None):
         transactions = list()
         if miner is not None:
             transactions.append(self.create_mining_reward(miner))
-            transactions += self.node.get_transaction_pool_as_list()
-        user_balences = self.node.user_balence_pool.copy()
-        previous_block_hash = self.hash(self.get_last_block()) if len(self.chain)>0 else None
+            transactions += self.node.get_block_transactions(config.MAX_BLOCK_TRANSACTIONS - 1)
+        user_balences = self.get_committed_user_balences()
+        for user in list(self.node.get_users()):
+            if user not in user_balences:
+                user_balences[user] = config.NEW_USER_REWARD
+        for transaction in transactions:
+            self.apply_transaction(user_balences, transaction)
+        previous_block_hash = self.get_last_block_hash() if len(self.chain)>0 else None
 
         block = {
             'index': len(self.chain),
             'previous_block_hash': previous_block_hash,
-            'timestamp': int(time()),
+            'timestamp': max(int(time()), self.get_median_time(self.chain.__getitem__, len(self.chain)) or 0),
             'transactions': transactions,
-            'user_balences': user_balences,
             'nonce': 0,
-            'target_bits': config.TARGET_BITS
+            'target': encode_target(self.get_expected_target(self.chain.__getitem__, len(self.chain)))
         }
+        if len(self.chain) % config.BALANCE_CHECKPOINT_INTERVAL == 0:
+            block['user_balences'] = user_balences
+        else:
+            block['balance_deltas'] = { user: balence - self.balences.get(user, 0)
+                                        for user, balence in user_balences.items()
+                                        if balence != self.balences.get(user) }
+        block['merkle_root'] = self.transactions_root(block)
+        block['balances_root'] = self.balances_root(block)
         return block
 
+    @staticmethod
+    def apply_transaction(balences, transaction):
+        sender = transaction.get('sender')
+        recipient = transaction.get('recipient')
+        amount = transaction.get('amount')
+        if sender != 'SYSTEM':
+            balences[sender] = balences.get(sender, 0) - amount
+        balences[recipient] = balences.get(recipient, 0) + amount
+
+    # Updating balences with the checkpoint or the deltas of a block
+    @staticmethod
+    def apply_balences(balences, block):
+        if block.get('user_balences') is not None:
+            balences.clear()
+            balences.update(block.get('user_balences'))
+        for user, delta in block.get('balance_deltas', dict()).items():
+            balences[user] = balences.get(user, 0) + delta
+
+    # Balences after the block at index: replaying the deltas since the last checkpoint
+    @classmethod
+    def compute_balences(cls, chain, index):
+        checkpoint = index
+        while checkpoint > 0 and chain[checkpoint].get('user_balences') is None:
+            checkpoint -= 1
+        balences = dict()
+        for i in range(max(checkpoint, 0), index + 1):
+            cls.apply_balences(balences, chain[i])
+        return balences
+
+    # Difficulty retargeting: every RETARGET_INTERVAL_IN_BLOCKS blocks the target is
+    # scaled by the time the last interval took over the configured block interval
+    # (limited to MAX_RETARGET_FACTOR). get_block(i) returns the block at index i
+    # of the chain the block at index is added to. Returns None for an invalid chain
+    @staticmethod
+    def get_expected_target(get_block, index):
+        if index == 0:
+            return target_from_bits(config.TARGET_BITS)
+        previous_target = decode_target(get_block(index - 1).get('target'))
+        interval = config.RETARGET_INTERVAL_IN_BLOCKS
+        if previous_target is None or index % interval != 0 or index <= interval:
+            return previous_target
+
+        expected_timespan = interval * config.BLOCK_INTERVAL_IN_SECONDS
+        timespan = get_block(index - 1).get('timestamp') - get_block(index - 1 - interval).get('timestamp')
+        target = previous_target * max(timespan, 0) // expected_timespan
+        target = max(target, previous_target // config.MAX_RETARGET_FACTOR)
+        target = min(target, previous_target * config.MAX_RETARGET_FACTOR)
+        return max(1, min(MAX_TARGET, target))
+
+    # Median timestamp of the MEDIAN_TIME_BLOCKS blocks before index (None for the genesis block)
+    @staticmethod
+    def get_median_time(get_block, index):
+        if index == 0:
+            return None
+        timestamps = sorted(get_block(i).get('timestamp') for i in range(max(0, index - config.MEDIAN_TIME_BLOCKS), index))
+        return timestamps[len(timestamps) // 2]
+
+    # A timestamp is an integer not earlier than the median time of the previous
+    # blocks (blocks of the same second are common) and not too far in the future.
+    # block is the block at index, get_block(i) returns the blocks before it
+    @classmethod
+    def is_valid_timestamp(cls, get_block, index, block, now):
+        timestamp = block.get('timestamp')
+        if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+            return False
+        if timestamp > now + config.MAX_FUTURE_BLOCK_TIME_IN_SECONDS:
+            return False
+        median_time = cls.get_median_time(get_block, index)
+        return median_time is None or timestamp >= median_time
+
 
     # Proof of work algorithm: A block is mined until SHA256 hash 
-    # of this block matching target bits
-    def mine(self, miner):
-        self.node.user_balence_pool[miner] += config.MINING_REWARD
-        candidate_block = self.create_new_block(miner)
-
-        # Proof of work: Mining a block by adjusting the nonce parameter
-        while self.is_valid_nonce(candidate_block, config.TARGET_BITS) is False:
-            candidate_block['nonce'] += 1
-
-        # Update pools after mining a new block and committing transactions
-        self.node.reset_transaction_pool()
-        self.chain.append(candidate_block)
+    # of this block is not greater than the target.
+    # Returns None if mining is aborted or the tip changed meanwhile
+    def mine(self, miner, abort_event=None):
+        if abort_event is None:
+            abort_event = threading.Event()
+        nonce = None
+        while nonce is None:
+            with self.lock:
+                candidate_block = self.create_new_block(miner)
+
+            # Proof of work: Mining a block by adjusting the nonce parameter of its header,
+            # the nonce space is searched by all mining workers in parallel. If it is
+            # exhausted the candidate block is built again (with a new reward transaction)
+            nonce = self.miner.mine(self.header_of(candidate_block), decode_target(candidate_block.get('target')), abort_event)
+            if nonce is None and abort_event.is_set():
+                return None
+        candidate_block['nonce'] = nonce
+
+        with self.lock:
+            # The candidate block is stale if another block was added while mining
+            if candidate_block.get('previous_block_hash') != self.get_last_block_hash():
+                return None
+
+            # Update pools after mining a new block and committing transactions
+            self.append_block(candidate_block, self.hash(candidate_block))
+            self.node.update_pools([candidate_block])
+        self.notify_tip_change()
         return candidate_block
 
     @staticmethod
@@ -80,45 +460,234 @@ class Blockchain(object):
         }
 
 
-    def is_valid_nonce(self, block, target_bits):
-        return self.hash(block)[ : target_bits] == ''.zfill(target_bits)
+    def is_valid_nonce(self, block, target):
+        return is_valid_hash(self.hash(block), target)
 
-    # A block is valid if hash of this block matching thr target bits
-    # and the previous_block_hash field equals to the hash of the previous block
-    def verify_block(self, block):
-        if block.get('previous_block_hash') != self.hash(self.chain[-1]):
+    # A block is valid if it records the expected target, hash of this block is not
+    # greater than this target, the previous_block_hash field equals to the hash
+    # of the previous block and its body matches the Merkle roots of its header
+    def verify_block(self, block, block_hash=None):
+        if block_hash is None:
+            block_hash = self.hash(block)
+        return self.verify_suffix(self.chain.__getitem__, len(self.chain), self.get_last_block_hash(),
+                                  [block], [block_hash])
+
+    # Each block of the chain is hashed only once, chain_hashes can be reused by the caller
+    def verify_chain(self, chain, chain_hashes=None):
+        return self.find_invalid_block(chain, chain_hashes) is None
+
+    # The genesis block is not mined, it records the initial target and a body matching its header
+    @classmethod
+    def check_genesis_block(cls, block):
+        if block.get('index') != 0 or block.get('previous_block_hash') is not None:
+            return False
+        if block.get('target') != encode_target(target_from_bits(config.TARGET_BITS)):
             return False
-        if self.is_valid_nonce(block, config.TARGET_BITS) is False:
+        if not cls.is_valid_timestamp(None, 0, block, time()):
             return False
-        return True;
+        return cls.verify_body(block)
+
+    # Index of the first invalid block of the chain, None if the chain is valid
+    def find_invalid_block(self, chain, chain_hashes=None):
+        if not self.check_genesis_block(chain[0]):
+            return 0
+        genesis_hash = chain_hashes[0] if chain_hashes is not None else self.hash(chain[0])
+        return self.find_invalid_suffix_block(chain.__getitem__, 1, genesis_hash, chain[1 : ],
+                                              chain_hashes[1 : ] if chain_hashes is not None else None)
+
+    # Verifying the blocks of suffix as the blocks from index fork onwards of a chain,
+    # following the block hashed as previous_block_hash.
+    # get_block(i) returns the block at index i of that chain
+    def verify_suffix(self, get_block, fork, previous_block_hash, suffix, suffix_hashes):
+        return self.find_invalid_suffix_block(get_block, fork, previous_block_hash, suffix, suffix_hashes) is None
 
-    def verify_chain(self, chain):
-        for i in range(1, len(chain)):
-           if chain[i].get('previous_block_hash') != self.hash(chain[i-1]):
-              return False
-           if self.is_valid_nonce(chain[i], config.TARGET_BITS) is False:
-              return False
-        return True;
+    # Index of the first invalid block of suffix, None if the suffix is valid. The
+    # timestamps are checked and the expected targets computed in order first, they
+    # only depend on header fields, then the blocks are hashed (if suffix_hashes is
+    # None) and checked by the verifier, in parallel for long suffixes. Only the
+    # blocks before the first invalid timestamp are left to the verifier
+    def find_invalid_suffix_block(self, get_block, fork, previous_block_hash, suffix, suffix_hashes=None):
+        targets = []
+        now = time()
+        invalid_timestamp = None
+        for index, block in enumerate(suffix, start=fork):
+            try:
+                if not self.is_valid_timestamp(get_block, index, block, now):
+                    invalid_timestamp = index
+                    break
+                targets.append(self.get_expected_target(get_block, index))
+            except TypeError:
+                # Malformed timestamps of previous blocks, invalid anyway
+                invalid_timestamp = index
+                break
+        if invalid_timestamp is not None:
+            suffix = suffix[ : invalid_timestamp - fork]
+            if suffix_hashes is not None:
+                suffix_hashes = suffix_hashes[ : invalid_timestamp - fork]
+            if len(suffix) == 0:
+                return invalid_timestamp
+        invalid, _ = self.verifier.verify(self.hash, self.check_block, fork, previous_block_hash,
+                                          suffix, targets, suffix_hashes)
+        return invalid if invalid is not None else invalid_timestamp
 
-    # Proof of work: Reaching consensus on longest valid chain
+    # Checks of a header before its body is downloaded: the timestamp is valid, the
+    # recorded target is the expected one and the hash is not greater than it
+    # (the genesis block is not mined). get_block(i) returns the blocks before it
+    @classmethod
+    def check_header(cls, get_block, index, header, header_hash, now):
+        try:
+            if not cls.is_valid_timestamp(get_block, index, header, now):
+                return False
+            target = cls.get_expected_target(get_block, index)
+        except (KeyError, TypeError):
+            return False
+        if target is None or header.get('target') != encode_target(target):
+            return False
+        return index == 0 or is_valid_hash(header_hash, target)
+
+    # Checks of a block needing no other block: the recorded target is the expected
+    # one, the hash of the block is not greater than it and the body matches the header
+    @classmethod
+    def check_block(cls, block, block_hash, target):
+        if target is None or block.get('target') != encode_target(target):
+            return False
+        if is_valid_hash(block_hash, target) is False:
+            return False
+        return cls.verify_body(block)
+
+    # Binary search of the longest common prefix of chain and the local chain.
+    # Equal hashes at an index imply equal ancestors, so the blocks matching
+    # the local chain always form a prefix. Returns the prefix length and the
+    # hashes of the chain computed during the search (keyed by index)
+    def find_fork_point(self, chain):
+        chain_hashes = dict()
+        low, high = 0, min(len(chain), len(self.chain))
+        while low < high:
+            middle = (low + high) // 2
+            chain_hashes[middle] = self.hash(chain[middle])
+            if chain_hashes[middle] == self.get_block_hash(middle):
+                low = middle + 1
+            else:
+                high = middle
+        return low, chain_hashes
+
+    # Proof of work: Reaching consensus on the valid chain with the most cumulative work
     def add_cahin(self,chain):
-        if len(chain) <= len(self.chain):
+        if len(chain) == 0:
             return False
         last_block = chain[-1]
-        if self.add_block(last_block):
+        if last_block.get('previous_block_hash') in self.tree and self.add_block(last_block):
             return True
-        elif self.verify_chain(chain):
-            self.chain = chain
-            self.node.reset_transaction_pool()
-            self.node.user_balence_pool = self.get_committed_user_balences()
-            return True
-        return False
 
-    # Add the block to tail of chain if its valid
+        # Only the suffix diverging from the local chain is verified and spliced in
+        fork, chain_hashes = self.find_fork_point(chain)
+        suffix = chain[fork : ]
+        suffix_hashes = [chain_hashes.get(index) or self.hash(chain[index]) for index in range(fork, len(chain))]
+        return self.add_suffix(fork, suffix, suffix_hashes)
+
+    # Replacing the local blocks from index fork onwards by suffix if the result
+    # is a valid chain with more cumulative work (suffix[0] follows the local block
+    # at fork-1), a valid suffix with less work is kept as a side branch of the tree.
+    # With replace, a valid suffix is spliced in even if the chain has less work.
+    # A chain with another genesis block (fork 0) is only taken with replace:
+    # the work of a genesis block is not proven, it cannot win the fork choice
+    def add_suffix(self, fork, suffix, suffix_hashes=None, replace=False):
+        if suffix_hashes is None:
+            suffix_hashes = self.hash_chain(suffix)
+        with self.lock:
+            if fork > len(self.chain) or len(suffix) == 0:
+                return False
+            if fork == 0 and not replace:
+                return False
+            if fork == 0:
+                valid = self.verify_chain(suffix, suffix_hashes)
+            else:
+                chain = self.chain
+                get_block = lambda index: chain[index] if index < fork else suffix[index - fork]
+                valid = self.verify_suffix(get_block, fork, self.get_block_hash(fork - 1), suffix, suffix_hashes)
+            if not valid:
+                return False
+            work = self.get_chain_work(fork)
+            work += sum(get_block_work(block) for block in suffix)
+            if work <= self.get_tip_work() and not replace:
+                if fork > 0 and fork >= len(self.chain) - config.BLOCK_TREE_MAX_FORK_DEPTH:
+                    for block, block_hash in zip(suffix, suffix_hashes):
+                        self.tree.add(block, block_hash)
+                return False
+            abandoned = self.splice_chain(fork, suffix, suffix_hashes)
+            self.node.update_pools(suffix, abandoned)
+        self.notify_tip_change()
+        return True
+
+    # Adding a block to the tree: appended if it extends the tip, otherwise added
+    # to its side branch (which becomes the chain if it gets more work), or kept
+    # as an orphan until its parent arrives. The orphans waiting for the block
+    # are connected after it. Returns True if the block is on the chain afterwards
     def add_block(self, block):
-        if block.get('index') == len(self.chain) and self.verify_block(block):
-            self.chain.append(block)
-            self.node.reset_transaction_pool()
-            self.node.user_balence_pool = self.get_committed_user_balences()
+        block_hash = self.hash(block)
+        if block_hash is None:
+            return False
+        with self.lock:
+            if block_hash in self.tree:
+                return False
+            if block.get('previous_block_hash') not in self.tree:
+                if self.is_valid_orphan(block, block_hash):
+                    self.tree.add_orphan(block, block_hash)
+                return False
+            if self.tree.is_orphan(block_hash):
+                self.tree.remove_orphan(block_hash)
+            tip_changed = self.connect_block(block, block_hash)
+            pending = self.tree.pop_orphans(block_hash) if block_hash in self.tree else []
+            while len(pending) > 0:
+                orphan, orphan_hash = pending.pop()
+                if self.connect_block(orphan, orphan_hash):
+                    tip_changed = True
+                if orphan_hash in self.tree:
+                    pending += self.tree.pop_orphans(orphan_hash)
+            added = self.is_main(block_hash)
+        if tip_changed:
+            self.notify_tip_change()
+        return added
+
+    # Connecting a block whose parent is in the tree. A block extending the tip is
+    # appended, a block of a side branch is verified against that branch and the
+    # branch replaces the chain from the fork point on if it has more cumulative
+    # work now. Returns True if the tip changed
+    def connect_block(self, block, block_hash):
+        previous_block_hash = block.get('previous_block_hash')
+        if previous_block_hash == self.get_last_block_hash():
+            if not self.verify_block(block, block_hash):
+                return False
+            self.append_block(block, block_hash)
+            self.node.update_pools([block])
             return True
-        return False
+
+        index = self.tree.get(previous_block_hash).get('height') + 1
+        branch = self.get_branch(previous_block_hash)
+        if branch is None or index < len(self.chain) - config.BLOCK_TREE_MAX_FORK_DEPTH:
+            return False
+        fork, blocks, block_hashes = branch
+        blocks, block_hashes = blocks + [block], block_hashes + [block_hash]
+        chain = self.chain
+        get_block = lambda i: chain[i] if i < fork else blocks[i - fork]
+        if not self.verify_suffix(get_block, index, previous_block_hash, [block], [block_hash]):
+            return False
+        self.tree.add(block, block_hash)
+        if self.tree.get_work(block_hash) <= self.get_tip_work():
+            return False
+        abandoned = self.splice_chain(fork, blocks, block_hashes)
+        self.node.update_pools(blocks, abandoned)
+        return True
+
+    # Orphans cannot be verified against their chain yet, only their proof of
+    # work and body are checked before they are buffered. Their target must be
+    # within MAX_RETARGET_FACTOR of the target of the tip, so that blocks with
+    # next to no work cannot fill the orphan pool
+    def is_valid_orphan(self, block, block_hash):
+        target = decode_target(block.get('target'))
+        tip_target = decode_target(self.get_last_block().get('target'))
+        if not isinstance(block.get('index'), int) or block.get('index') <= 0 or target is None:
+            return False
+        if not tip_target // config.MAX_RETARGET_FACTOR <= target <= tip_target * config.MAX_RETARGET_FACTOR:
+            return False
+        return is_valid_hash(block_hash, target) and self.verify_body(block)
@@ -0,0 +1,51 @@
+import json
+from threading import Lock
+
+
+# Serialization cache of the chain: the encoded bytes of each block are kept
+# and only concatenated for a response, so only the blocks appended since the
+# previous response are encoded. Cached blocks are matched to the chain by hash
+# (each block records the hash of the previous one), after a fork only the
+# blocks from the fork point on are encoded again. Requests share one update
+# under the lock and the body is reused as long as the tip is unchanged.
+class ChainCache(object):
+    def __init__(self, encode_block, join_blocks):
+        self.encode_block = encode_block
+        self.join_blocks = join_blocks
+        self.encoded_blocks = []
+        self.block_hashes = []
+        self.tip_hash = None
+        self.body = None
+        self.lock = Lock()
+
+    # chain is a snapshot of the chain and tip_hash the hash of its last block
+    def get_body(self, chain, tip_hash):
+        with self.lock:
+            if self.body is not None and self.tip_hash == tip_hash and len(self.encoded_blocks) == len(chain):
+                return self.body
+            cached = min(len(self.encoded_blocks), len(chain))
+            while cached > 0 and self.block_hashes[cached - 1] != self.get_hash(chain, cached - 1, tip_hash):
+                cached -= 1
+            del self.encoded_blocks[cached : ]
+            del self.block_hashes[cached : ]
+            for index in range(cached, len(chain)):
+                self.encoded_blocks.append(self.encode_block(chain[index]))
+                self.block_hashes.append(self.get_hash(chain, index, tip_hash))
+            self.body = self.join_blocks(self.encoded_blocks)
+            self.tip_hash = tip_hash
+            return self.body
+
+    # The hash of a block is recorded by the next one, only the tip is hashed
+    @staticmethod
+    def get_hash(chain, index, tip_hash):
+        if index + 1 < len(chain):
+            return chain[index + 1].get('previous_block_hash')
+        return tip_hash
+
+
+# JSON array of the blocks
+def encode_json_block(block):
+    return json.dumps(block, sort_keys=True, separators=(',', ':')).encode()
+
+def join_json_blocks(encoded_blocks):
+    return b'[' + b','.join(encoded_blocks) + b']'
@@ -0,0 +1,52 @@
+from blockchain import Blockchain
+import config
+import hashlib
+
+
+# Compact block relay: a new block is announced with its header, its balences
+# and short ids of its transactions instead of the transactions themselves.
+# Peers already hold most of them in their transaction pool and rebuild the
+# block from it, only the missing transactions are pulled from the announcing peer.
+WIRE_FORMAT = 'compact/1'
+
+
+# Short id of a transaction in a block, salted with the block hash so that
+# transaction ids colliding in every block cannot be crafted
+def get_short_id(block_hash, transaction_id):
+    digest = hashlib.sha256(f'{block_hash}:{transaction_id}'.encode()).hexdigest()
+    return digest[ : config.COMPACT_BLOCK_SHORT_ID_LENGTH]
+
+# Mining rewards are never pooled by peers, they are sent in full
+def create_compact_block(block, block_hash):
+    transactions = block.get('transactions')
+    return {
+        'header': Blockchain.header_of(block),
+        'balances': { field: block.get(field) for field in ('user_balences', 'balance_deltas')
+                      if block.get(field) is not None },
+        'short_ids': [get_short_id(block_hash, transaction.get('transaction_id')) for transaction in transactions],
+        'prefilled_transactions': [[index, transaction] for index, transaction in enumerate(transactions)
+                                   if transaction.get('sender') == 'SYSTEM']
+    }
+
+def is_compact_block(compact_block):
+    return isinstance(compact_block, dict) and isinstance(compact_block.get('header'), dict) and \
+           isinstance(compact_block.get('balances', dict()), dict) and \
+           isinstance(compact_block.get('short_ids'), list) and \
+           isinstance(compact_block.get('prefilled_transactions', list()), list) and \
+           all(isinstance(prefilled, list) and len(prefilled) == 2 and isinstance(prefilled[0], int)
+               for prefilled in compact_block.get('prefilled_transactions', list()))
+
+# Rebuilding the block from the transactions a node holds. Returns the block
+# and the indexes of the transactions still missing from it (left as None)
+def reconstruct_block(compact_block, block_hash, transactions):
+    by_short_id = { get_short_id(block_hash, transaction.get('transaction_id')): transaction
+                    for transaction in transactions }
+    block_transactions = [by_short_id.get(short_id) for short_id in compact_block.get('short_ids')]
+    for index, transaction in compact_block.get('prefilled_transactions', list()):
+        if 0 <= index < len(block_transactions):
+            block_transactions[index] = transaction
+    block = dict(compact_block.get('header'))
+    block.update(compact_block.get('balances', dict()))
+    block['transactions'] = block_transactions
+    missing = [index for index, transaction in enumerate(block_transactions) if transaction is None]
+    return block, missing
@@ -1,7 +1,110 @@
+import os
+
 CONNECTION_TIMEOUT_IN_SECONDS = 3
 
 NEW_USER_REWARD = 100
 
 MINING_REWARD = 50
 
-TARGET_BITS = 4
+TARGET_BITS = 16
+
+RETARGET_INTERVAL_IN_BLOCKS = 10
+
+BLOCK_INTERVAL_IN_SECONDS = 10
+
+MAX_RETARGET_FACTOR = 4
+
+MEDIAN_TIME_BLOCKS = 11
+
+MAX_FUTURE_BLOCK_TIME_IN_SECONDS = 7200
+
+BALANCE_CHECKPOINT_INTERVAL = 10
+
+MEMPOOL_CAPACITY = 10000
+
+MEMPOOL_EXPIRY_IN_SECONDS = 3600
+
+MAX_BLOCK_TRANSACTIONS = 1000
+
+MAX_BLOCK_SIZE_IN_BYTES = 1000000
+
+MINING_WORKERS = os.cpu_count() or 1
+
+MINING_CANCEL_CHECK_INTERVAL = 1000
+
+MINING_ABORT_CHECK_INTERVAL_IN_SECONDS = 0.1
+
+MINING_JOB_MAX_RESTARTS = 100
+
+MINING_JOB_MAX_WAIT_IN_SECONDS = 30
+
+MINING_JOB_HISTORY = 100
+
+FANOUT_WORKERS = 16
+
+FANOUT_MAX_PEER_POOLS = 64
+
+FANOUT_CONNECTIONS_PER_PEER = 4
+
+FANOUT_FIRE_AND_FORGET = False
+
+BLOCK_STORE_DIR = None
+
+BLOCK_STORE_FSYNC = False
+
+SYNC_HEADERS_PAGE_SIZE = 500
+
+SYNC_BLOCKS_PAGE_SIZE = 20
+
+SYNC_MAX_BUFFERED_BLOCKS = 1000
+
+SYNC_MAX_RETRIES = 3
+
+MAX_HEADERS_PER_REQUEST = 2000
+
+MAX_BLOCKS_PER_REQUEST = 100
+
+# Blocks are exchanged in the binary encoding with peers supporting it
+# (less than half the bytes of JSON, but slower to decode in Python than the
+# C JSON parser, so only worth it on slow links)
+WIRE_FORMAT_BINARY = False
+
+GOSSIP_FANOUT = 8
+
+GOSSIP_SEEN_CAPACITY = 100000
+
+MAX_TRANSACTIONS_PER_BATCH = 1000
+
+BALENCE_LOCK_STRIPES = 64
+
+MINING_WORK_RANGE_SIZE = 2 ** 20
+
+MINING_WORK_TEMPLATE_MAX_AGE_IN_SECONDS = 30
+
+MINING_WORK_MAX_TEMPLATES = 1000
+
+ORPHAN_POOL_CAPACITY = 100
+
+BLOCK_TREE_MAX_FORK_DEPTH = 100
+
+# New blocks are relayed as compact blocks to peers supporting them
+COMPACT_BLOCKS = True
+
+COMPACT_BLOCK_SHORT_ID_LENGTH = 12
+
+# Transactions are announced by id to peers supporting it, the peers request the ones they miss
+INVENTORY_ANNOUNCEMENTS = True
+
+INVENTORY_WINDOW_IN_SECONDS = 0.1
+
+INVENTORY_MAX_BATCH = 1000
+
+INVENTORY_REQUEST_TIMEOUT_IN_SECONDS = 5
+
+# Chains of at least PARALLEL_VERIFICATION_MIN_BLOCKS blocks are verified across
+# VERIFIER_WORKERS processes, in VERIFIER_SHARDS_PER_WORKER shards per process
+VERIFIER_WORKERS = os.cpu_count() or 1
+
+PARALLEL_VERIFICATION_MIN_BLOCKS = 1000
+
+VERIFIER_SHARDS_PER_WORKER = 4
@@ -0,0 +1,284 @@
+import re
+import struct
+
+
+# Deterministic, versioned binary encoding of blocks and transactions, used as
+# the hash preimage of block headers and as the optional wire format for blocks.
+#
+# A block is its fixed-size header followed by its body:
+#   header:  version, index, previous_block_hash, timestamp, target,
+#            merkle_root, balances_root and the nonce last, so the hash state
+#            of everything before the nonce can be reused while mining
+#   body:    balence kind (checkpoint or deltas) and the balences,
+#            then the number of transactions and each transaction length-prefixed
+# Transactions with the usual fields (a UUID transaction_id, sender, recipient,
+# integer amount and timestamp) are packed: the UUID in 16 bytes, amount and
+# timestamp as 64-bit integers, the name lengths, then the names. Other transactions
+# and balences use a tagged value encoding with sorted dict keys.
+# Encoding errors are raised as ValueError.
+VERSION = 1
+
+# Version 2 of the wire format packs transactions, the header version is unchanged
+WIRE_FORMAT = 'binary/2'
+
+MIME_TYPE = 'application/x-pow-block'
+
+HEADER = struct.Struct('>BQ32sq32s32s32sQ')
+
+HEADER_SIZE = HEADER.size
+
+LENGTH = struct.Struct('>I')
+
+PACKED_TRANSACTION = struct.Struct('>16sqqHH')
+
+TRANSACTION_FIELDS = { 'transaction_id', 'sender', 'recipient', 'amount', 'timestamp' }
+
+UUID_PATTERN = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+EMPTY_HASH = bytes(32)
+
+BALENCE_FIELDS = ( 'user_balences', 'balance_deltas' )
+
+
+###############
+# Values
+###############
+
+INT = struct.Struct('>q')
+
+FLOAT = struct.Struct('>d')
+
+def encode_value(value):
+    if value is None:
+        return b'N'
+    if value is True:
+        return b'T'
+    if value is False:
+        return b'F'
+    if isinstance(value, int):
+        if -2**63 <= value < 2**63:
+            return b'i' + INT.pack(value)
+        data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+        return b'I' + LENGTH.pack(len(data)) + data
+    if isinstance(value, float):
+        return b'f' + FLOAT.pack(value)
+    if isinstance(value, str):
+        data = value.encode()
+        return b's' + LENGTH.pack(len(data)) + data
+    if isinstance(value, (list, tuple)):
+        return b'l' + LENGTH.pack(len(value)) + b''.join(encode_value(v) for v in value)
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise ValueError('Dict keys must be strings')
+        items = sorted(value.items())
+        return b'd' + LENGTH.pack(len(items)) + b''.join(encode_value(k) + encode_value(v) for k, v in items)
+    raise ValueError(f'Cannot encode {type(value).__name__}')
+
+def read(data, offset, size):
+    if offset + size > len(data):
+        raise ValueError('Truncated data')
+    return data[offset : offset + size], offset + size
+
+def read_length(data, offset):
+    chunk, offset = read(data, offset, LENGTH.size)
+    return LENGTH.unpack(chunk)[0], offset
+
+# Returns the decoded value and the offset after it
+def decode_value(data, offset=0):
+    tag, offset = read(data, offset, 1)
+    if tag == b'N':
+        return None, offset
+    if tag == b'T':
+        return True, offset
+    if tag == b'F':
+        return False, offset
+    if tag == b'i':
+        chunk, offset = read(data, offset, INT.size)
+        return INT.unpack(chunk)[0], offset
+    if tag == b'I':
+        length, offset = read_length(data, offset)
+        chunk, offset = read(data, offset, length)
+        return int.from_bytes(chunk, 'big', signed=True), offset
+    if tag == b'f':
+        chunk, offset = read(data, offset, FLOAT.size)
+        return FLOAT.unpack(chunk)[0], offset
+    if tag == b's':
+        length, offset = read_length(data, offset)
+        chunk, offset = read(data, offset, length)
+        return bytes(chunk).decode(), offset
+    if tag == b'l':
+        length, offset = read_length(data, offset)
+        values = []
+        for _ in range(length):
+            value, offset = decode_value(data, offset)
+            values.append(value)
+        return values, offset
+    if tag == b'd':
+        length, offset = read_length(data, offset)
+        values = dict()
+        for _ in range(length):
+            key, offset = decode_value(data, offset)
+            values[key], offset = decode_value(data, offset)
+        return values, offset
+    raise ValueError(f'Unknown tag {tag!r}')
+
+
+###############
+# Headers
+###############
+
+def encode_hash(value, allow_none=False):
+    if value is None and allow_none:
+        return EMPTY_HASH
+    if not isinstance(value, str) or len(value) != 64:
+        raise ValueError('Invalid hash')
+    return bytes.fromhex(value)
+
+def decode_hash(data, allow_none=False):
+    if data == EMPTY_HASH and allow_none:
+        return None
+    return bytes(data).hex()
+
+def encode_header(block):
+    try:
+        return HEADER.pack(VERSION,
+                           block.get('index'),
+                           encode_hash(block.get('previous_block_hash'), allow_none=True),
+                           block.get('timestamp'),
+                           encode_hash(block.get('target')),
+                           encode_hash(block.get('merkle_root')),
+                           encode_hash(block.get('balances_root')),
+                           block.get('nonce'))
+    except struct.error as e:
+        raise ValueError(str(e))
+
+def decode_header(data, offset=0):
+    chunk, offset = read(data, offset, HEADER_SIZE)
+    version, index, previous_block_hash, timestamp, target, merkle_root, balances_root, nonce = HEADER.unpack(chunk)
+    if version != VERSION:
+        raise ValueError(f'Unsupported encoding version {version}')
+    header = {
+        'index': index,
+        'previous_block_hash': decode_hash(previous_block_hash, allow_none=True),
+        'timestamp': timestamp,
+        'nonce': nonce,
+        'target': decode_hash(target),
+        'merkle_root': decode_hash(merkle_root),
+        'balances_root': decode_hash(balances_root)
+    }
+    return header, offset
+
+
+###############
+# Transactions
+###############
+
+def decode_uuid(data):
+    value = data.hex()
+    return f'{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}'
+
+# Packed encoding of a transaction with the usual fields, None for any other transaction
+def pack_transaction(transaction):
+    if not isinstance(transaction, dict) or transaction.keys() != TRANSACTION_FIELDS:
+        return None
+    transaction_id = transaction.get('transaction_id')
+    sender = transaction.get('sender')
+    recipient = transaction.get('recipient')
+    amount = transaction.get('amount')
+    timestamp = transaction.get('timestamp')
+    if not isinstance(transaction_id, str) or UUID_PATTERN.fullmatch(transaction_id) is None \
+       or not isinstance(sender, str) or not isinstance(recipient, str) \
+       or type(amount) is not int or type(timestamp) is not int:
+        return None
+    sender = sender.encode()
+    recipient = recipient.encode()
+    try:
+        return b'P' + PACKED_TRANSACTION.pack(bytes.fromhex(transaction_id.replace('-', '')), amount, timestamp,
+                                              len(sender), len(recipient)) + sender + recipient
+    except struct.error:
+        return None
+
+def encode_transaction(transaction):
+    data = pack_transaction(transaction)
+    if data is None:
+        data = encode_value(transaction)
+    return LENGTH.pack(len(data)) + data
+
+# Returns the decoded transaction and the offset after it
+def decode_transaction(data, offset=0):
+    if data[offset : offset + 1] != b'P':
+        return decode_value(data, offset)
+    start = offset + 1 + PACKED_TRANSACTION.size
+    if start > len(data):
+        raise ValueError('Truncated data')
+    transaction_id, amount, timestamp, sender_length, recipient_length = PACKED_TRANSACTION.unpack_from(data, offset + 1)
+    middle = start + sender_length
+    end = middle + recipient_length
+    if end > len(data):
+        raise ValueError('Truncated data')
+    transaction = {
+        'transaction_id': decode_uuid(transaction_id),
+        'sender': str(data[start : middle], 'utf-8'),
+        'recipient': str(data[middle : end], 'utf-8'),
+        'amount': amount,
+        'timestamp': timestamp
+    }
+    return transaction, end
+
+
+###############
+# Blocks
+###############
+
+def encode_block(block):
+    parts = [encode_header(block)]
+    kind = next((i for i, field in enumerate(BALENCE_FIELDS) if block.get(field) is not None), len(BALENCE_FIELDS))
+    parts.append(bytes([kind]))
+    if kind < len(BALENCE_FIELDS):
+        parts.append(encode_value(block.get(BALENCE_FIELDS[kind])))
+    transactions = block.get('transactions')
+    if not isinstance(transactions, list):
+        raise ValueError('Invalid transactions')
+    parts.append(LENGTH.pack(len(transactions)))
+    parts += [encode_transaction(transaction) for transaction in transactions]
+    return b''.join(parts)
+
+# Returns the decoded block and the offset after it
+def decode_block(data, offset=0):
+    block, offset = decode_header(data, offset)
+    kind, offset = read(data, offset, 1)
+    if kind[0] < len(BALENCE_FIELDS):
+        block[BALENCE_FIELDS[kind[0]]], offset = decode_value(data, offset)
+    elif kind[0] != len(BALENCE_FIELDS):
+        raise ValueError('Unknown balence kind')
+    count, offset = read_length(data, offset)
+    block['transactions'] = []
+    for _ in range(count):
+        length, offset = read_length(data, offset)
+        transaction, end = decode_transaction(data, offset)
+        if end != offset + length:
+            raise ValueError('Invalid transaction length')
+        block['transactions'].append(transaction)
+        offset = end
+    return block, offset
+
+def encode_blocks(blocks):
+    parts = [LENGTH.pack(len(blocks))]
+    for block in blocks:
+        data = encode_block(block)
+        parts += [LENGTH.pack(len(data)), data]
+    return b''.join(parts)
+
+def decode_blocks(data):
+    count, offset = read_length(data, 0)
+    blocks = []
+    for _ in range(count):
+        length, offset = read_length(data, offset)
+        block, end = decode_block(data, offset)
+        if end != offset + length:
+            raise ValueError('Invalid block length')
+        blocks.append(block)
+        offset = end
+    if offset != len(data):
+        raise ValueError('Trailing data')
+    return blocks
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import config
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+
+
+# Shared peer fan-out: a persistent requests.Session keeps a pool of keep-alive
+# connections per peer, and the messages to all peers are sent in parallel by
+# a bounded thread pool. A broadcast therefore takes as long as the slowest
+# live peer instead of the sum over all peers.
+class Fanout(object):
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=config.FANOUT_MAX_PEER_POOLS,
+                              pool_maxsize=config.FANOUT_CONNECTIONS_PER_PEER)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=config.FANOUT_WORKERS, thread_name_prefix='fanout')
+
+
+    def get(self, peer, path, params=None, headers=None):
+        return self.session.get(url=f'http://{peer}{path}', params=params, headers=headers,
+                                timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+
+    # Either json or raw data (with its Content-Type in headers) is posted
+    def post(self, peer, path, json=None, data=None, headers=None, params=None):
+        return self.session.post(url=f'http://{peer}{path}', json=json, data=data, headers=headers,
+                                 params=params, timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+
+    # Failures are only logged, a dead peer does not stop the broadcast
+    def try_post(self, peer, path, **message):
+        try:
+            return self.post(peer, path, **message)
+        except Exception as e:
+            print(e)
+        return None
+
+    # Posting json to all peers in parallel. Returns the responses by peer
+    # (None for failed peers), or None right away in fire-and-forget mode
+    def broadcast(self, peers, path, json, fire_and_forget=None):
+        return self.broadcast_messages({ peer: { 'json': json } for peer in list(peers) }, path, fire_and_forget)
+
+    # Calling back after delay seconds on a timer thread
+    def call_later(self, delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+
+    # Like broadcast, with a message per peer given as the keyword arguments of post
+    def broadcast_messages(self, messages, path, fire_and_forget=None):
+        if fire_and_forget is None:
+            fire_and_forget = config.FANOUT_FIRE_AND_FORGET
+        futures = { peer: self.executor.submit(self.try_post, peer, path, **message) for peer, message in messages.items() }
+        if fire_and_forget:
+            return None
+        wait(futures.values())
+        return { peer: future.result() for peer, future in futures.items() }
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+import config
+import random
+import threading
+
+
+# Gossip dissemination: a transaction or block is sent to GOSSIP_FANOUT random
+# peers only, and every node relays the items it accepts for the first time to
+# GOSSIP_FANOUT other random peers. The send load of a node stays constant as
+# the network grows while an item still reaches all nodes in O(log N) hops.
+# Accepted items are remembered in a bounded LRU set (keyed by transaction id
+# or block hash), so duplicates received from several peers are dropped.
+class Gossip(object):
+    def __init__(self):
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_seen(self, key):
+        with self.lock:
+            if key in self.seen:
+                self.seen.move_to_end(key)
+                return True
+            return False
+
+    def mark_seen(self, key):
+        with self.lock:
+            self.seen[key] = None
+            self.seen.move_to_end(key)
+            while len(self.seen) > config.GOSSIP_SEEN_CAPACITY:
+                self.seen.popitem(last=False)
+
+    # Random peers to send an item to, never the peers it was received from
+    def select_peers(self, peers, exclude=()):
+        candidates = [peer for peer in list(peers) if peer not in exclude]
+        if len(candidates) <= config.GOSSIP_FANOUT:
+            return candidates
+        return random.sample(candidates, config.GOSSIP_FANOUT)
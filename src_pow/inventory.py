@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import config
+from threading import Lock
+from time import time
+
+
+# Inventory protocol for transactions: instead of pushing transactions, nodes
+# announce their ids (inv) and peers request only the ids they do not hold
+# (getdata), the transactions are then sent to them with /transaction/add.
+# Announcements and requests are queued per peer and sent together every
+# INVENTORY_WINDOW_IN_SECONDS (or as soon as a queue holds INVENTORY_MAX_BATCH ids),
+# so many of them share one HTTP request. An id is requested from one peer only,
+# and from another one if it did not arrive within INVENTORY_REQUEST_TIMEOUT_IN_SECONDS.
+WIRE_FORMAT = 'inv/1'
+
+
+class Inventory(object):
+    def __init__(self, node):
+        self.node = node
+        self.announcements = dict()
+        self.requests = dict()
+        # Ids requested from peers and the time they were requested at
+        self.requested = OrderedDict()
+        self.flush_scheduled = False
+        self.lock = Lock()
+
+    def announce(self, peers, transaction_ids):
+        with self.lock:
+            for peer in peers:
+                self.announcements.setdefault(peer, []).extend(transaction_ids)
+        self.schedule_flush()
+
+    def request(self, peer, transaction_ids):
+        now = time()
+        with self.lock:
+            transaction_ids = [transaction_id for transaction_id in transaction_ids
+                               if now - self.requested.get(transaction_id, 0) > config.INVENTORY_REQUEST_TIMEOUT_IN_SECONDS]
+            for transaction_id in transaction_ids:
+                self.requested[transaction_id] = now
+                self.requested.move_to_end(transaction_id)
+            while len(self.requested) > config.GOSSIP_SEEN_CAPACITY:
+                self.requested.popitem(last=False)
+            if len(transaction_ids) > 0:
+                self.requests.setdefault(peer, []).extend(transaction_ids)
+        self.schedule_flush()
+
+    # Flushing right away if a queue is full or there is no window,
+    # otherwise once at the end of the window
+    def schedule_flush(self):
+        with self.lock:
+            queues = list(self.announcements.values()) + list(self.requests.values())
+            if len(queues) == 0:
+                return
+            full = max(len(queue) for queue in queues) >= config.INVENTORY_MAX_BATCH
+            if config.INVENTORY_WINDOW_IN_SECONDS > 0 and not full:
+                if self.flush_scheduled:
+                    return
+                self.flush_scheduled = True
+        if config.INVENTORY_WINDOW_IN_SECONDS > 0 and not full:
+            self.node.fanout.call_later(config.INVENTORY_WINDOW_IN_SECONDS, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            announcements, self.announcements = self.announcements, dict()
+            requests, self.requests = self.requests, dict()
+            self.flush_scheduled = False
+        self.send(announcements, '/transaction/inv')
+        self.send(requests, '/transaction/getdata')
+
+    # One message per peer and INVENTORY_MAX_BATCH ids
+    def send(self, queues, path):
+        start = 0
+        while True:
+            messages = { peer: { 'json': { 'transaction_ids': transaction_ids[start : start + config.INVENTORY_MAX_BATCH],
+                                           'peer': self.node.get_socket() } }
+                         for peer, transaction_ids in queues.items() if len(transaction_ids) > start }
+            if len(messages) == 0:
+                return
+            self.node.fanout.broadcast_messages(messages, path, fire_and_forget=True)
+            start += config.INVENTORY_MAX_BATCH
@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+import threading
+
+
+# Striped locks: keys are hashed onto a fixed number of locks, so updates of
+# different keys mostly run in parallel while the number of locks stays bounded.
+# Stripes are always acquired in ascending order, which rules out deadlocks
+# between threads holding several of them.
+class StripedLock(object):
+    def __init__(self, stripes):
+        self.locks = [threading.Lock() for _ in range(max(1, stripes))]
+
+    def get_stripe(self, key):
+        return hash(str(key)) % len(self.locks)
+
+    @contextmanager
+    def acquire_stripes(self, stripes):
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.locks[stripe].release()
+
+    # Holding the locks of all given keys
+    def hold(self, *keys):
+        return self.acquire_stripes(sorted({ self.get_stripe(key) for key in keys }))
+
+    # Holding every stripe, for updates spanning all keys
+    def hold_all(self):
+        return self.acquire_stripes(list(range(len(self.locks))))
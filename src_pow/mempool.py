@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import config
+import json
+import threading
+from time import time
+
+
+# Reason given for a transaction rejected because the pool is full
+POOL_FULL = 'Transaction pool full'
+
+# Bounded transaction pool kept in arrival order. Older transactions have
+# priority: they are put into blocks first. When MEMPOOL_CAPACITY is reached
+# new transactions, the ones with the lowest priority, are rejected, and
+# transactions pooled for longer than MEMPOOL_EXPIRY_IN_SECONDS expire.
+# All methods are thread-safe.
+class Mempool(object):
+    def __init__(self, transactions=None):
+        self.transactions = OrderedDict()
+        self.arrival_times = dict()
+        # Pooled transaction ids of each sender in arrival order
+        self.by_sender = dict()
+        # Arrival times of the latest committed transactions, kept to restore
+        # them if their block is abandoned by a reorg
+        self.committed_arrival_times = OrderedDict()
+        self.lock = threading.RLock()
+        for transaction in (transactions or dict()).values():
+            self.add(transaction)
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self.transactions
+
+    def get(self, transaction_id):
+        return self.transactions.get(transaction_id)
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.transactions)
+
+    def as_list(self):
+        with self.lock:
+            return list(self.transactions.values())
+
+
+    def is_full(self):
+        return len(self.transactions) >= config.MEMPOOL_CAPACITY
+
+    # Returns False if the transaction is already pooled or the pool is full
+    def add(self, transaction):
+        transaction_id = transaction.get('transaction_id')
+        with self.lock:
+            if transaction_id in self.transactions or len(self.transactions) >= config.MEMPOOL_CAPACITY:
+                return False
+            self.transactions[transaction_id] = transaction
+            self.arrival_times[transaction_id] = time()
+            self.by_sender.setdefault(transaction.get('sender'), dict())[transaction_id] = None
+            return True
+
+    # Committed transactions leave the pool
+    def remove(self, transaction_ids):
+        with self.lock:
+            for transaction_id in transaction_ids:
+                if transaction_id in self.transactions:
+                    self.committed_arrival_times[transaction_id] = self.arrival_times[transaction_id]
+                    self.discard(transaction_id)
+            while len(self.committed_arrival_times) > config.MEMPOOL_CAPACITY:
+                self.committed_arrival_times.popitem(last=False)
+
+    # Transactions of abandoned blocks go back to their place in arrival order,
+    # with their original arrival time (their timestamp if it is not known).
+    # Older transactions have priority, so the newest ones are dropped if the
+    # pool overflows. Returns the dropped transactions
+    def restore(self, transactions):
+        if len(transactions) == 0:
+            return []
+        with self.lock:
+            for transaction in transactions:
+                transaction_id = transaction.get('transaction_id')
+                if transaction_id not in self.transactions:
+                    self.transactions[transaction_id] = transaction
+                    self.arrival_times[transaction_id] = self.committed_arrival_times.pop(
+                        transaction_id, min(transaction.get('timestamp'), time()))
+            self.transactions = OrderedDict((transaction_id, self.transactions[transaction_id])
+                                            for transaction_id in sorted(self.transactions, key=self.arrival_times.get))
+            self.by_sender = dict()
+            for transaction_id, transaction in self.transactions.items():
+                self.by_sender.setdefault(transaction.get('sender'), dict())[transaction_id] = None
+            dropped = []
+            while len(self.transactions) > config.MEMPOOL_CAPACITY:
+                dropped.append(self.discard(next(reversed(self.transactions))))
+            return dropped
+
+    def discard(self, transaction_id):
+        transaction = self.transactions.pop(transaction_id)
+        del self.arrival_times[transaction_id]
+        sent = self.by_sender.get(transaction.get('sender'))
+        del sent[transaction_id]
+        if len(sent) == 0:
+            del self.by_sender[transaction.get('sender')]
+        return transaction
+
+    def pop_oldest(self):
+        with self.lock:
+            return self.discard(next(iter(self.transactions)))
+
+    # The latest pooled transaction of the sender, None if there is none
+    def pop_newest_sent_by(self, sender):
+        with self.lock:
+            sent = self.by_sender.get(sender)
+            if sent is None:
+                return None
+            return self.discard(next(reversed(sent)))
+
+    def has_expired(self):
+        with self.lock:
+            return len(self.transactions) > 0 and \
+                   self.arrival_times[next(iter(self.transactions))] < time() - config.MEMPOOL_EXPIRY_IN_SECONDS
+
+    # Returns the expired transactions
+    def expire(self):
+        expired = []
+        deadline = time() - config.MEMPOOL_EXPIRY_IN_SECONDS
+        with self.lock:
+            while self.transactions and self.arrival_times[next(iter(self.transactions))] < deadline:
+                expired.append(self.pop_oldest())
+        return expired
+
+
+    # Block template: the oldest transactions within the block limits
+    # (max_count transactions, MAX_BLOCK_SIZE_IN_BYTES of encoded transactions)
+    def select_for_block(self, max_count):
+        selected = []
+        size = 0
+        with self.lock:
+            transactions = list(self.transactions.values())
+        for transaction in transactions:
+            if len(selected) >= max_count:
+                break
+            transaction_size = len(json.dumps(transaction, sort_keys=True))
+            if size + transaction_size > config.MAX_BLOCK_SIZE_IN_BYTES:
+                break
+            selected.append(transaction)
+            size += transaction_size
+        return selected
@@ -0,0 +1,53 @@
+import hashlib
+import json
+
+
+# Merkle trees over JSON encoded items. Leaves and inner nodes are hashed with
+# different prefixes, and the last node of an odd level is paired with itself
+EMPTY_ROOT = hashlib.sha256(b'').hexdigest()
+
+
+def hash_leaf(item):
+    return hashlib.sha256(b'\x00' + json.dumps(item, sort_keys=True).encode()).hexdigest()
+
+def hash_node(left, right):
+    return hashlib.sha256(b'\x01' + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def next_level(level):
+    if len(level) % 2 == 1:
+        level = level + [level[-1]]
+    return [hash_node(level[i], level[i+1]) for i in range(0, len(level), 2)]
+
+
+def merkle_root(items):
+    level = [hash_leaf(item) for item in items]
+    if len(level) == 0:
+        return EMPTY_ROOT
+    while len(level) > 1:
+        level = next_level(level)
+    return level[0]
+
+# Inclusion proof of items[index]: the sibling hashes from the leaf up to the root
+def merkle_proof(items, index):
+    level = [hash_leaf(item) for item in items]
+    proof = []
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling == len(level):
+            sibling = index
+        proof.append({
+            'hash': level[sibling],
+            'side': 'left' if sibling < index else 'right'
+        })
+        level = next_level(level)
+        index //= 2
+    return proof
+
+def verify_merkle_proof(item, proof, root):
+    node = hash_leaf(item)
+    for step in proof:
+        if step.get('side') == 'left':
+            node = hash_node(step.get('hash'), node)
+        else:
+            node = hash_node(node, step.get('hash'))
+    return node == root
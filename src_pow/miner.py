@@ -0,0 +1,142 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import config
+from encoding import encode_header
+import hashlib
+import multiprocessing
+import struct
+import threading
+
+
+# Cancellation flag shared by all processes of the mining pool
+_cancel_event = None
+
+
+def _init_worker(cancel_event):
+    global _cancel_event
+    _cancel_event = cancel_event
+
+
+MAX_TARGET = 2 ** 256 - 1
+
+# The nonce is an unsigned 64-bit field of the header
+MAX_NONCE = 2 ** 64 - 1
+
+
+# Difficulty is an integer target: a block hash read as a 256-bit number
+# is valid if it is not greater than the target
+def target_from_bits(target_bits):
+    return MAX_TARGET >> target_bits
+
+def encode_target(target):
+    return format(target, '064x')
+
+def decode_target(target_hex):
+    try:
+        return int(target_hex, 16)
+    except (TypeError, ValueError):
+        return None
+
+def is_valid_hash(block_hash, target):
+    if block_hash is None:
+        return False
+    return int(block_hash, 16) <= target
+
+
+# Mining fast path: the header is encoded only once, the nonce is its last
+# field, so the SHA256 state fed with all bytes before the nonce is copied
+# for each attempt and only the 8 bytes of the nonce are hashed.
+# The resulting hash is byte-identical to Blockchain.hash.
+class NonceHasher(object):
+    NONCE = struct.Struct('>Q')
+
+    def __init__(self, header):
+        prefix = encode_header(dict(header, nonce=0))[ : -self.NONCE.size]
+        self.prefix_state = hashlib.sha256(prefix)
+
+    def get_state(self, nonce):
+        state = self.prefix_state.copy()
+        state.update(self.NONCE.pack(nonce))
+        return state
+
+    def hash(self, nonce):
+        return self.get_state(nonce).hexdigest()
+
+    # The hash as a 256-bit number, compared with the target while mining
+    def hash_value(self, nonce):
+        return int.from_bytes(self.get_state(nonce).digest(), 'big')
+
+
+# Trying nonces start, start+stride, start+2*stride, ... up to MAX_NONCE until a valid
+# one is found or the search is cancelled (checked every MINING_CANCEL_CHECK_INTERVAL nonces).
+# Returns None as nonce if there is none, the block template has to be rebuilt then
+def search_nonce(block, start, stride, target, cancel_event):
+    hasher = NonceHasher(block)
+    nonce = start
+    attempts = 0
+    while nonce <= MAX_NONCE:
+        attempts += 1
+        if hasher.hash_value(nonce) <= target:
+            return nonce, attempts
+        if attempts % config.MINING_CANCEL_CHECK_INTERVAL == 0 and cancel_event.is_set():
+            return None, attempts
+        nonce += stride
+    return None, attempts
+
+
+def _search_nonce_in_worker(block, start, stride, target):
+    return search_nonce(block, start, stride, target, _cancel_event)
+
+
+# Parallel mining engine: the nonce space is split across a process pool,
+# worker i searches nonces i, i+N, i+2N, ... so the workers never overlap.
+# The first valid nonce wins and the other workers are cancelled.
+class Miner(object):
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.executor = None
+        self.cancel_event = None
+        self.attempts = 0
+
+    def get_executor(self):
+        if self.executor is None:
+            self.cancel_event = multiprocessing.Event()
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                initializer=_init_worker,
+                                                initargs=(self.cancel_event,))
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.cancel_event.set()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    # Returns a nonce making the block hash not greater than the target,
+    # or None if the search is aborted through abort_event or the nonce space is exhausted
+    def mine(self, block, target, abort_event=None):
+        if abort_event is None:
+            abort_event = threading.Event()
+        if self.workers == 1:
+            nonce, self.attempts = search_nonce(block, 0, 1, target, abort_event)
+            return nonce
+
+        executor = self.get_executor()
+        self.cancel_event.clear()
+        futures = [executor.submit(_search_nonce_in_worker, block, i, self.workers, target)
+                   for i in range(self.workers)]
+        nonce = None
+        pending = futures
+        while nonce is None and pending and not abort_event.is_set():
+            done, pending = wait(pending, timeout=config.MINING_ABORT_CHECK_INTERVAL_IN_SECONDS,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                found, _ = future.result()
+                if found is not None and (nonce is None or found < nonce):
+                    nonce = found
+
+        # Cancelling the remaining workers
+        self.cancel_event.set()
+        wait(futures)
+        self.attempts = sum(future.result()[1] for future in futures)
+        self.cancel_event.clear()
+        return nonce
@@ -0,0 +1,125 @@
+import config
+from queue import Queue
+from threading import Condition, Event, Thread
+from time import time
+from uuid import uuid4
+
+
+# Background mining: a mining request returns a job id right away and the jobs
+# are mined one after another by a worker thread (each job already keeps all
+# mining processes busy). Whenever the tip of the chain changes, the running job
+# is aborted and restarted on a template built on top of the new tip.
+class MiningJobManager(object):
+    FINISHED_STATUSES = { 'done', 'cancelled', 'failed' }
+
+    def __init__(self, node):
+        self.node = node
+        self.jobs = dict()
+        self.queue = Queue()
+        self.condition = Condition()
+        self.current_job_id = None
+        self.abort_event = Event()
+        self.thread = None
+        self.node.blockchain.add_tip_listener(self.on_tip_change)
+
+
+    def get_job(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def submit(self, miner):
+        job = {
+            'job_id': str(uuid4()),
+            'miner': miner,
+            'status': 'queued',
+            'restarts': 0,
+            'created_at': int(time()),
+            'finished_at': None,
+            'new_block': None
+        }
+        with self.condition:
+            self.jobs[job.get('job_id')] = job
+            self.prune_finished_jobs()
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='mining', daemon=True)
+                self.thread.start()
+        self.queue.put(job.get('job_id'))
+        return dict(job)
+
+    # Long polling: blocks until the job is finished or the timeout expires
+    def wait(self, job_id, timeout):
+        with self.condition:
+            if job_id not in self.jobs:
+                return None
+            self.condition.wait_for(lambda: self.jobs[job_id].get('status') in self.FINISHED_STATUSES,
+                                    timeout=timeout)
+            return dict(self.jobs[job_id])
+
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.get('status') in self.FINISHED_STATUSES:
+                return False
+            job['cancel_requested'] = True
+            if job.get('status') == 'queued':
+                self.finish(job, 'cancelled')
+            elif job_id == self.current_job_id:
+                self.abort_event.set()
+            return True
+
+    # Aborting the running job, it will be restarted on the new tip
+    def on_tip_change(self):
+        with self.condition:
+            if self.current_job_id is not None:
+                self.abort_event.set()
+
+
+    def run(self):
+        while True:
+            job_id = self.queue.get()
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is None or job.get('status') != 'queued':
+                    continue
+                job['status'] = 'mining'
+                self.current_job_id = job_id
+                self.abort_event.clear()
+
+            while True:
+                try:
+                    new_block = self.node.mine(job.get('miner'), self.abort_event)
+                except Exception as e:
+                    print(e)
+                    with self.condition:
+                        self.finish(job, 'failed')
+                    break
+
+                with self.condition:
+                    if new_block is not None:
+                        job['new_block'] = new_block
+                        self.finish(job, 'done')
+                        break
+                    if job.get('cancel_requested'):
+                        self.finish(job, 'cancelled')
+                        break
+                    if job.get('restarts') >= config.MINING_JOB_MAX_RESTARTS:
+                        self.finish(job, 'failed')
+                        break
+                    # The tip changed: rebuilding the template on the new tip
+                    job['restarts'] += 1
+                    self.abort_event.clear()
+
+    # Must be called while holding self.condition
+    def finish(self, job, status):
+        job['status'] = status
+        job['finished_at'] = int(time())
+        if job.get('job_id') == self.current_job_id:
+            self.current_job_id = None
+        self.condition.notify_all()
+
+    # Must be called while holding self.condition
+    def prune_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.get('status') in self.FINISHED_STATUSES]
+        for job_id in finished[ : max(0, len(finished) - config.MINING_JOB_HISTORY)]:
+            del self.jobs[job_id]
@@ -0,0 +1,73 @@
+import config
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+
+# Work distribution for external mining workers: a worker gets a block template
+# together with a range of nonces no other worker gets for that template, and
+# submits the nonce it found. Only the header of the template is handed out,
+# which is all a worker needs to hash. Templates are built per miner (the
+# mining reward goes to that user), refreshed after MINING_WORK_TEMPLATE_MAX_AGE_IN_SECONDS
+# to include new transactions, and dropped whenever the tip of the chain changes.
+class MiningWorkManager(object):
+    def __init__(self, node):
+        self.node = node
+        self.templates = dict()
+        self.current_templates = dict()
+        self.lock = Lock()
+        self.node.blockchain.add_tip_listener(self.on_tip_change)
+
+    def on_tip_change(self):
+        with self.lock:
+            self.templates.clear()
+            self.current_templates.clear()
+
+    def create_template(self, miner):
+        with self.node.blockchain.lock:
+            block = self.node.blockchain.create_new_block(miner)
+        template = {
+            'template_id': str(uuid4()),
+            'miner': miner,
+            'block': block,
+            'created_at': time(),
+            'next_nonce': 0
+        }
+        self.templates[template.get('template_id')] = template
+        self.current_templates[miner] = template
+        while len(self.templates) > config.MINING_WORK_MAX_TEMPLATES:
+            self.templates.pop(next(iter(self.templates)))
+        return template
+
+    # The current template of the miner and the next nonce range of it
+    def get_work(self, miner):
+        with self.lock:
+            template = self.current_templates.get(miner)
+            if template is None or template.get('template_id') not in self.templates or \
+               time() - template.get('created_at') > config.MINING_WORK_TEMPLATE_MAX_AGE_IN_SECONDS or \
+               template.get('next_nonce') + config.MINING_WORK_RANGE_SIZE > 2 ** 64:
+                template = self.create_template(miner)
+            nonce_start = template.get('next_nonce')
+            template['next_nonce'] += config.MINING_WORK_RANGE_SIZE
+        block = template.get('block')
+        return {
+            'template_id': template.get('template_id'),
+            'header': self.node.blockchain.header_of(block),
+            'target': block.get('target'),
+            'nonce_start': nonce_start,
+            'nonce_end': nonce_start + config.MINING_WORK_RANGE_SIZE
+        }
+
+    # Returns the new block, or None with the reason it was rejected
+    def submit(self, template_id, nonce):
+        with self.lock:
+            template = self.templates.get(template_id)
+        if template is None:
+            return None, 'Unknown or stale template'
+        if not isinstance(nonce, int) or nonce < 0 or nonce >= template.get('next_nonce'):
+            return None, 'Nonce out of the ranges handed out'
+        block = dict(template.get('block'), nonce=nonce)
+        if not self.node.blockchain.add_block(block):
+            return None, 'Invalid proof of work or stale template'
+        self.node.broadcast_block(block)
+        return block, None
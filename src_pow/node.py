@@ -1,19 +1,48 @@
+from block_store import BlockStore
+from block_tree import get_block_work
 from blockchain import Blockchain
+from chain_cache import ChainCache, encode_json_block, join_json_blocks
+import compact_block
 import config
+import encoding
+from fanout import Fanout
+from gossip import Gossip
+import inventory
 import json
-import requests
+from locks import StripedLock
+from mempool import Mempool, POOL_FULL
+from mining_job import MiningJobManager
+from mining_work import MiningWorkManager
+import os
 from time import time
 from uuid import uuid4
 
 
+# Concurrency: a request handler updating the balence pool holds the striped
+# locks of the accounts involved, and rebuilding the whole balence pool holds
+# all stripes. The mempool and the chain have locks of their own, the lock order
+# is chain, balence stripes, mempool.
 class Node(object):
-    def __init__(self, host, port):
+    # fanout: the transport to peers, a Fanout over HTTP by default
+    def __init__(self, host, port, data_dir=None, fanout=None):
         self.socket = host+':'+str(port)
         self.peers = set()
         self.users = dict()
-        self.transaction_pool = dict()
+        self.transaction_pool = Mempool()
         self.user_balence_pool = dict()
+        self.balence_locks = StripedLock(config.BALENCE_LOCK_STRIPES)
+        self.fanout = fanout if fanout is not None else Fanout()
+        # Wire formats supported by each peer, as advertised by GET /
+        self.peer_wire_formats = dict()
+        self.json_chain_cache = ChainCache(encode_json_block, join_json_blocks)
+        self.gossip = Gossip()
+        self.inventory = inventory.Inventory(self)
+        self.block_store = BlockStore(os.path.join(data_dir, f'node_{port}')) if data_dir is not None else None
         self.blockchain = Blockchain(self)
+        self.mining_jobs = MiningJobManager(self)
+        self.mining_work = MiningWorkManager(self)
+        if self.block_store is not None:
+            self.recover_from_store()
         # broadcast_ methods: for broadcast changes by sending message to peers
         # add_* methods: for verifying and adding broadcasted changes
 
@@ -25,23 +54,150 @@ class Node(object):
     def get_socket(self):
        return self.socket
 
+    def get_wire_formats(self):
+        wire_formats = ['json']
+        if config.WIRE_FORMAT_BINARY:
+            wire_formats.insert(0, encoding.WIRE_FORMAT)
+        if config.COMPACT_BLOCKS:
+            wire_formats.insert(0, compact_block.WIRE_FORMAT)
+        if config.INVENTORY_ANNOUNCEMENTS:
+            wire_formats.insert(0, inventory.WIRE_FORMAT)
+        return wire_formats
+
+    # Recovering users and balences after a restart, the chain itself
+    # is recovered by the blockchain from the block store
+    def recover_from_store(self):
+        self.users = self.block_store.load_users()
+        self.rebuild_user_balence_pool()
+
     # Initialization node by replicating from ann existing peer node
+    # The blockchain itself is synchronized in pages, see sync_from_peer
     def clone_from_peer(self, peer):
         try:
-            response = requests.get(url=f'http://{peer}/node/clone', timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
-            if response.status_code == 200:
+            response = self.fanout.get(peer, '/node/clone', params={'blockchain': 'false'})
+            if response.status_code == 200 and self.sync_from_peer(peer, replace=True):
                 replica = response.json()  
                 for p in replica.get('peers'):
                     self.add_peer(p)
                 self.users = replica.get('users')
-                self.transaction_pool = replica.get('transaction_pool')
+                if self.block_store is not None:
+                    self.block_store.save_users(self.users)
+                self.transaction_pool = Mempool(replica.get('transaction_pool'))
                 self.user_balence_pool = replica.get('user_balence_pool')
-                self.blockchain.set_chain(replica.get('blockchain'))
                 return True
         except Exception as e:
             print(e)
         return False
 
+    # Headers-first chain synchronization in bounded pages. The fork point with
+    # the peer is found by binary search over its headers, each page of headers
+    # must hash to the advertised hashes, link up, record the expected targets
+    # and valid timestamps and meet their targets before the matching block bodies
+    # are downloaded and checked against the header hashes. The work of the
+    # headers tells when the blocks make a chain with more work, they are spliced
+    # in then (or right away with replace), so only the blocks of a reorg are held
+    # in memory (at most SYNC_MAX_BUFFERED_BLOCKS) and a failed sync resumes from
+    # the local tip next time. The sync is aborted on the first invalid block.
+    # Returns True if the local chain ends with the tip of the peer afterwards
+    def sync_from_peer(self, peer, replace=False):
+        page = self.get_peer_page(peer, '/blockchain/headers', 0, 1)
+        if page is None:
+            return False
+        remote_length = page.get('length')
+        fork = self.find_peer_fork_point(peer, remote_length)
+        if fork is None:
+            return False
+
+        # Headers of the peer needed for the expected targets and median times,
+        # the local chain below the fork point is shared with the peer
+        chain = self.blockchain.get_chain()
+        first_fork = fork
+        recent_headers = dict()
+        window = max(config.RETARGET_INTERVAL_IN_BLOCKS, config.MEDIAN_TIME_BLOCKS) + 1
+        get_block = lambda index: chain[index] if index < first_fork else recent_headers[index]
+
+        previous_block_hash = self.blockchain.get_block_hash(fork - 1) if fork > 0 else None
+        work = self.blockchain.get_chain_work(fork)
+        blocks, block_hashes = [], []
+        start = fork
+        while start < remote_length:
+            page = self.get_peer_page(peer, '/blockchain/headers', start, config.SYNC_HEADERS_PAGE_SIZE)
+            if page is None or len(page.get('headers')) == 0:
+                return False
+            headers = page.get('headers')
+            now = time()
+            for index, header in enumerate(headers, start=start):
+                if header.get('index') != index:
+                    return False
+                if index > 0 and header.get('previous_block_hash') != previous_block_hash:
+                    return False
+                if self.blockchain.hash(header) != header.get('hash'):
+                    return False
+                if not self.blockchain.check_header(get_block, index, header, header.get('hash'), now):
+                    return False
+                recent_headers[index] = header
+                recent_headers.pop(index - window, None)
+                work += get_block_work(header)
+                previous_block_hash = header.get('hash')
+
+            offset = 0
+            while offset < len(headers):
+                count = min(config.SYNC_BLOCKS_PAGE_SIZE, len(headers) - offset)
+                page = self.get_peer_page(peer, '/blockchain/blocks', start + offset, count)
+                if page is None or len(page.get('blocks')) == 0:
+                    return False
+                for block, header in zip(page.get('blocks'), headers[offset : ]):
+                    block_hash = self.blockchain.hash(block)
+                    if block_hash != header.get('hash'):
+                        return False
+                    blocks.append(block)
+                    block_hashes.append(block_hash)
+                offset += len(page.get('blocks'))
+                if len(blocks) > config.SYNC_MAX_BUFFERED_BLOCKS:
+                    return False
+
+                # Work of the chain of the peer up to the last downloaded block
+                blocks_work = work - sum(get_block_work(header) for header in headers[offset : ])
+                if replace or blocks_work > self.blockchain.get_tip_work():
+                    # Failing only for an invalid block (or if the local chain changed meanwhile)
+                    if not self.blockchain.add_suffix(fork, blocks, block_hashes, replace):
+                        return False
+                    fork += len(blocks)
+                    blocks, block_hashes = [], []
+                    replace = False
+            start += len(headers)
+        # Blocks left over do not make a chain with more work than the local one
+        return len(blocks) == 0
+
+    # Binary search of the longest common prefix with the chain of the peer
+    def find_peer_fork_point(self, peer, remote_length):
+        low, high = 0, min(remote_length, len(self.blockchain.get_chain()))
+        while low < high:
+            middle = (low + high) // 2
+            page = self.get_peer_page(peer, '/blockchain/headers', middle, 1)
+            if page is None or len(page.get('headers')) == 0:
+                return None
+            if page.get('headers')[0].get('hash') == self.blockchain.get_block_hash(middle):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Pages of blocks are downloaded in the binary encoding if the peer supports it
+    def get_peer_page(self, peer, path, start, count):
+        binary = path == '/blockchain/blocks' and self.supports_binary(peer)
+        headers = { 'Accept': encoding.MIME_TYPE } if binary else None
+        for attempt in range(config.SYNC_MAX_RETRIES):
+            try:
+                response = self.fanout.get(peer, path, params={'from': start, 'count': count}, headers=headers)
+                if response.status_code == 200:
+                    if response.headers.get('Content-Type') == encoding.MIME_TYPE:
+                        return { 'blocks': encoding.decode_blocks(response.content) }
+                    return response.json()
+            except Exception as e:
+                print(e)
+        return None
+
 
     ####################
     # P2P Network Peers
@@ -53,8 +209,9 @@ class Node(object):
     def register_peer(self, peer):
         if peer!=self.socket:
             try:
-                response = requests.get(url=f'http://{peer}/', timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+                response = self.fanout.get(peer, '/')
                 if response.status_code == 200:
+                    self.peer_wire_formats[peer] = response.json().get('wire_formats', ['json'])
                     self.broadcast_peer(peer)
                     self.peers.add(peer)
                     return True
@@ -68,13 +225,32 @@ class Node(object):
             return True
         return False
 
-    def broadcast_peer(self, peer):
-        json = { 'peer': peer }
-        for node in self.peers:
+    # The wire formats of a peer are asked for once, a peer that cannot be
+    # reached is assumed to support JSON only until asked again
+    def get_peer_wire_formats(self, peer):
+        if peer not in self.peer_wire_formats:
             try:
-                response = requests.post(url=f'http://{node}/peer/add', json=json , timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+                response = self.fanout.get(peer, '/')
+                if response.status_code != 200:
+                    return ['json']
+                self.peer_wire_formats[peer] = response.json().get('wire_formats', ['json'])
             except Exception as e:
                 print(e)
+                return ['json']
+        return self.peer_wire_formats[peer]
+
+    def supports_binary(self, peer):
+        return config.WIRE_FORMAT_BINARY and encoding.WIRE_FORMAT in self.get_peer_wire_formats(peer)
+
+    def supports_compact_blocks(self, peer):
+        return config.COMPACT_BLOCKS and compact_block.WIRE_FORMAT in self.get_peer_wire_formats(peer)
+
+    def supports_inventory(self, peer):
+        return config.INVENTORY_ANNOUNCEMENTS and inventory.WIRE_FORMAT in self.get_peer_wire_formats(peer)
+
+    def broadcast_peer(self, peer):
+        json = { 'peer': peer }
+        self.fanout.broadcast(self.peers, '/peer/add', json)
 
 
     ###############
@@ -84,30 +260,30 @@ class Node(object):
     def get_users(self):
         return self.users
 
+    # Only the request that actually inserted the user broadcasts it
     def register_user(self, user, password):
-        if user in self.users:
+        if not self.add_user(user, password):
             return False
-        self.add_user(user, password)
         self.broadcast_user(user, password)
         return True
 
+    # The user is inserted under the locks of all accounts. Returns False if it already exists
     def add_user(self, user, password):
-        if user not in self.users:
-            self.users[user] = password
-            self.user_balence_pool[user] = config.NEW_USER_REWARD
-            return True
-        return False
+        with self.balence_locks.hold_all():
+            if user not in self.users:
+                self.users[user] = password
+                self.user_balence_pool[user] = config.NEW_USER_REWARD
+                if self.block_store is not None:
+                    self.block_store.save_users(self.users)
+                return True
+            return False
 
     def authenticate_user(self, user, password):
         return self.users.get(user) == password
 
     def broadcast_user(self, user, password):
         json = { 'username': user, 'password': password }
-        for node in self.peers:
-            try:
-                response = requests.post(url=f'http://{node}/user/add', json=json , timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
-            except Exception as e:
-                print(e)
+        self.fanout.broadcast(self.peers, '/user/add', json)
 
 
     #############################
@@ -115,34 +291,124 @@ class Node(object):
     ##############################
 
     def get_transaction_pool(self):
-        return self.transaction_pool
+        return self.transaction_pool.as_dict()
 
     def get_transaction_pool_as_list(self):
-        return list(self.transaction_pool.values())
+        return self.transaction_pool.as_list()
 
-    def reset_transaction_pool(self):
-        self.transaction_pool = dict()
+    def get_block_transactions(self, max_count):
+        return self.transaction_pool.select_for_block(max_count)
 
     def start_transaction(self, sender, recipient, amount):
-        if self.verify_transaction(sender, recipient, amount):
-            transaction = self.create_transaction(sender, amount, recipient)
-            self.transaction_pool[transaction.get('transaction_id')] = transaction
-            self.update_user_balence_pool(sender, recipient, amount)
+        transaction, error = self.add_payment(sender, recipient, amount)
+        if transaction is not None:
             self.broadcast_transaction(transaction)
-            return transaction
+        return transaction, error
+
+    # Pooling a new payment without broadcasting it. Returns the transaction,
+    # or None with the reason it was rejected
+    def add_payment(self, sender, recipient, amount):
+        if self.transaction_pool.is_full():
+            return None, POOL_FULL
+        transaction = self.create_transaction(sender, amount, recipient)
+        if self.pool_transaction(transaction):
+            return transaction, None
+        elif self.transaction_pool.is_full():
+            return None, POOL_FULL
         else:
-            return None
+            return None, 'No enough balence or invalid recipient'
 
-    def add_transaction(self, transaction):
+    # A transaction gossiped by peer is relayed to other peers once accepted
+    def add_transaction(self, transaction, peer=None):
+        if self.accept_transaction(transaction):
+            self.broadcast_transaction(transaction, exclude=[peer], relay=True)
+            return True
+        return False
+
+    # The transactions of a batch are added in order and the accepted ones
+    # relayed together. Returns the accepted transactions
+    def add_transactions(self, transactions, peer=None):
+        accepted = [transaction for transaction in transactions
+                    if isinstance(transaction, dict) and self.accept_transaction(transaction)]
+        self.broadcast_transactions(accepted, exclude=[peer], relay=True)
+        return accepted
+
+    def accept_transaction(self, transaction):
+        if self.gossip.is_seen(transaction.get('transaction_id')):
+            return False
+        return self.pool_transaction(transaction)
+
+    # The transaction is verified against the balence pool and pooled under the
+    # locks of both accounts. Returns False for an invalid or already pooled one,
+    # or if the pool is full. Expired transactions are reversed in the balence pool first
+    def pool_transaction(self, transaction):
         transaction_id = transaction.get('transaction_id')
         sender = transaction.get('sender')
         recipient = transaction.get('recipient')
         amount = transaction.get('amount')
-        if self.verify_transaction(sender, recipient, amount):
-            self.transaction_pool[transaction_id] = transaction  
+        if self.transaction_pool.has_expired():
+            self.expire_transactions()
+        with self.balence_locks.hold(sender, recipient):
+            if transaction_id in self.transaction_pool or not self.verify_transaction(sender, recipient, amount):
+                return False
+            if not self.transaction_pool.add(transaction):
+                return False
             self.update_user_balence_pool(sender, recipient, amount)
-            return True
-        return False
+        return True
+
+    # Committed transactions leave the pool, the others stay pooled for next blocks.
+    # Transactions of blocks abandoned by a reorg go back to the pool in their
+    # original arrival order unless committed again, the balence pool rebuild
+    # drops those no longer valid
+    def update_pools(self, committed_blocks, abandoned_blocks=()):
+        committed_ids = { transaction.get('transaction_id')
+                          for block in committed_blocks for transaction in block.get('transactions') }
+        self.transaction_pool.remove(committed_ids)
+        self.transaction_pool.restore([transaction for block in abandoned_blocks for transaction in block.get('transactions')
+                                       if transaction.get('sender') != 'SYSTEM' and
+                                          transaction.get('transaction_id') not in committed_ids])
+        self.transaction_pool.expire()
+        self.rebuild_user_balence_pool()
+
+    # Balence pool: committed balences, rewards of users not committed yet and the
+    # pooled transactions in order. Transactions no longer valid are dropped
+    def rebuild_user_balence_pool(self):
+        with self.balence_locks.hold_all():
+            user_balence_pool = self.get_committed_user_balences()
+            for user in self.users:
+                if user not in user_balence_pool:
+                    user_balence_pool[user] = config.NEW_USER_REWARD
+            invalid_ids = []
+            for transaction in self.transaction_pool.as_list():
+                sender = transaction.get('sender')
+                recipient = transaction.get('recipient')
+                amount = transaction.get('amount')
+                if user_balence_pool.get(sender) is None or user_balence_pool.get(recipient) is None \
+                   or user_balence_pool.get(sender) < amount:
+                    invalid_ids.append(transaction.get('transaction_id'))
+                else:
+                    Blockchain.apply_transaction(user_balence_pool, transaction)
+            self.transaction_pool.remove(invalid_ids)
+            self.user_balence_pool = user_balence_pool
+
+    # Expired transactions are reversed in the balence pool instead of a rebuild.
+    # A recipient left with a negative balence loses its latest pooled payments,
+    # reversed in turn, until its balence is covered again
+    def expire_transactions(self):
+        with self.balence_locks.hold_all():
+            uncovered = set()
+            for transaction in self.transaction_pool.expire():
+                self.update_user_balence_pool(transaction.get('sender'), transaction.get('recipient'),
+                                              -transaction.get('amount'))
+                uncovered.add(transaction.get('recipient'))
+            while len(uncovered) > 0:
+                user = uncovered.pop()
+                while self.user_balence_pool.get(user) < 0:
+                    transaction = self.transaction_pool.pop_newest_sent_by(user)
+                    if transaction is None:
+                        break
+                    self.update_user_balence_pool(user, transaction.get('recipient'), -transaction.get('amount'))
+                    uncovered.add(transaction.get('recipient'))
 
     def verify_transaction(self, sender, recipient, amount):
        if self.user_balence_pool.get(sender) is None or self.user_balence_pool.get(recipient) is None:
@@ -159,13 +425,49 @@ class Node(object):
             'timestamp': int(time())
         }
 
-    def broadcast_transaction(self, transaction):
-        json = { 'transaction': transaction }
-        for node in self.peers:
-            try:
-                response = requests.post(url=f'http://{node}/transaction/add', json=json , timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
-            except Exception as e:
-                print(e)
+    # Gossiping to GOSSIP_FANOUT random peers, relays never wait for the peers
+    def broadcast_transaction(self, transaction, exclude=(), relay=False):
+        self.gossip.mark_seen(transaction.get('transaction_id'))
+        json = { 'transaction': transaction, 'peer': self.socket }
+        peers = self.announce_transactions([transaction], exclude)
+        self.fanout.broadcast(peers, '/transaction/add', json, fire_and_forget=True if relay else None)
+
+    # Many transactions in a single message to each peer
+    def broadcast_transactions(self, transactions, exclude=(), relay=False):
+        if len(transactions) == 0:
+            return
+        for transaction in transactions:
+            self.gossip.mark_seen(transaction.get('transaction_id'))
+        json = { 'transactions': transactions, 'peer': self.socket }
+        peers = self.announce_transactions(transactions, exclude)
+        self.fanout.broadcast(peers, '/transaction/add', json, fire_and_forget=True if relay else None)
+
+    # The transactions are gossiped to GOSSIP_FANOUT random peers: the ones supporting
+    # the inventory protocol get their ids in their next announcements. Returns
+    # the other selected peers, the transactions are pushed to them
+    def announce_transactions(self, transactions, exclude=()):
+        peers = self.gossip.select_peers(self.peers, exclude)
+        inventory_peers = [peer for peer in peers if self.supports_inventory(peer)]
+        if len(inventory_peers) > 0:
+            self.inventory.announce(inventory_peers, [transaction.get('transaction_id') for transaction in transactions])
+        return [peer for peer in peers if peer not in inventory_peers]
+
+    # Announced transactions neither pooled nor seen yet are requested from the peer
+    def add_inventory(self, transaction_ids, peer):
+        wanted = [transaction_id for transaction_id in transaction_ids
+                  if isinstance(transaction_id, str) and transaction_id not in self.transaction_pool
+                  and not self.gossip.is_seen(transaction_id)]
+        self.inventory.request(peer, wanted)
+        return wanted
+
+    # Answering a request: the pooled transactions among the ids are sent to the peer
+    def send_transactions(self, transaction_ids, peer):
+        transactions = [self.transaction_pool.get(transaction_id) for transaction_id in transaction_ids]
+        transactions = [transaction for transaction in transactions if transaction is not None]
+        if len(transactions) > 0:
+            json = { 'transactions': transactions, 'peer': self.socket }
+            self.fanout.broadcast([peer], '/transaction/add', json, fire_and_forget=True)
+        return transactions
 
 
     def get_user_balence_pool(self):
@@ -183,34 +485,210 @@ class Node(object):
     def get_full_chain(self):
         return self.blockchain.get_chain()
 
+    # The chain and the hash of its last block, as one consistent snapshot
+    def get_chain_snapshot(self):
+        return self.blockchain.get_chain_snapshot()
+
     def get_last_block(self):
         return self.blockchain.get_last_block()
 
     def get_committed_user_balences(self):
         return self.blockchain.get_committed_user_balences()
 
-    def mine(self, miner):
-        new_block = self.blockchain.mine(miner)
+    def get_committed_user_balence(self, user):
+        return self.blockchain.get_committed_user_balence(user)
+
+    def mine(self, miner, abort_event=None):
+        new_block = self.blockchain.mine(miner, abort_event)
         if new_block is not None:
-            new_blockchain = self.blockchain.get_chain()
-            self.broadcast_chain(new_blockchain)
+            self.broadcast_block(new_block)
         return new_block
 
+    def start_mining_job(self, miner):
+        return self.mining_jobs.submit(miner)
+
+    def get_mining_job(self, job_id):
+        return self.mining_jobs.get_job(job_id)
+
+    def wait_mining_job(self, job_id, timeout):
+        return self.mining_jobs.wait(job_id, timeout)
+
+    def cancel_mining_job(self, job_id):
+        return self.mining_jobs.cancel(job_id)
+
+    def get_mining_work(self, miner):
+        return self.mining_work.get_work(miner)
+
+    def submit_mining_work(self, template_id, nonce):
+        return self.mining_work.submit(template_id, nonce)
+
     def add_chain(self, chain):
         return self.blockchain.add_cahin(chain)
 
     def broadcast_chain(self, chain):
         json = { 'blockchain': chain }
-        for node in self.peers:
+        self.fanout.broadcast(self.peers, '/blockchain/add', json)
+
+    def get_block(self, index):
+        chain = self.blockchain.get_chain()
+        if 0 <= index < len(chain):
+            return chain[index]
+        return None
+
+    # Transactions at the indexes of a block of the block tree, None if the block is unknown
+    def get_block_transactions_by_hash(self, block_hash, indexes):
+        block = self.blockchain.get_block_by_hash(block_hash)
+        if block is None:
+            return None
+        transactions = block.get('transactions')
+        if any(not 0 <= index < len(transactions) for index in indexes):
+            return None
+        return [transactions[index] for index in indexes]
+
+    # Merkle inclusion proof of a committed transaction, searching from the tip
+    def get_transaction_proof(self, transaction_id):
+        chain = self.blockchain.get_chain()
+        for index in range(len(chain) - 1, -1, -1):
+            for position, transaction in enumerate(chain[index].get('transactions')):
+                if transaction.get('transaction_id') == transaction_id:
+                    return {
+                        'transaction': transaction,
+                        'block_index': index,
+                        'block_hash': self.blockchain.get_block_hash(index),
+                        'merkle_root': chain[index].get('merkle_root'),
+                        'proof': self.blockchain.get_transaction_proof(index, position)
+                    }
+        return None
+
+    # JSON encoded blocks, read as stored from the block store of the node if it has one
+    def get_encoded_block(self, index):
+        if index < 0:
+            return None
+        if self.block_store is not None:
+            return self.block_store.get_block_data(index)
+        block = self.get_block(index)
+        return encode_json_block(block) if block is not None else None
+
+    def get_encoded_blocks(self, start, count):
+        start = max(start, 0)
+        count = max(0, min(count, config.MAX_BLOCKS_PER_REQUEST))
+        if self.block_store is not None:
+            return self.block_store.get_blocks_data(start, count)
+        return [encode_json_block(block) for block in self.get_blocks(start, count)]
+
+    # Ranges are clamped to from >= 0 and 0 <= count <= MAX_*_PER_REQUEST
+    def get_headers(self, start, count):
+        start = max(start, 0)
+        end = min(start + max(0, min(count, config.MAX_HEADERS_PER_REQUEST)), len(self.blockchain.get_chain()))
+        return [self.blockchain.get_header(index) for index in range(start, end)]
+
+    def get_blocks(self, start, count):
+        chain = self.blockchain.get_chain()
+        start = max(start, 0)
+        return chain[start : start + max(0, min(count, config.MAX_BLOCKS_PER_REQUEST))]
+
+    # A block announced by a peer is added to the block tree. If it is an orphan,
+    # its missing ancestors are pulled from that peer and added in chain order,
+    # the last one connects the orphan. Deeper forks are synchronized from the
+    # peer in pages instead. A block that makes it to the chain is relayed to
+    # other peers, which pull missing ancestors from this node
+    def add_block(self, block, peer=None):
+        block_hash = self.blockchain.hash(block)
+        if self.gossip.is_seen(block_hash):
+            return False
+        if self.blockchain.add_block(block):
+            self.broadcast_block(block, exclude=[peer], relay=True)
+            return True
+        if peer is None or not self.blockchain.is_orphan(block_hash):
+            return False
+        ancestors = self.fetch_missing_ancestors(block, peer)
+        if ancestors is not None:
+            for ancestor in ancestors:
+                self.blockchain.add_block(ancestor)
+        elif self.sync_from_peer(peer):
+            self.blockchain.add_block(block)
+        if self.blockchain.is_main(block_hash):
+            self.broadcast_block(block, exclude=[peer], relay=True)
+            return True
+        return False
+
+    # A compact block is rebuilt from the transaction pool, only the transactions
+    # missing from it are pulled from the announcing peer. If the rebuilt body does
+    # not match the header (colliding short ids), all transactions are pulled
+    def add_compact_block(self, compact, peer):
+        block_hash = self.blockchain.hash(compact.get('header'))
+        if block_hash is None or self.gossip.is_seen(block_hash) or self.blockchain.has_block(block_hash):
+            return False
+        block, missing = compact_block.reconstruct_block(compact, block_hash, self.transaction_pool.as_list())
+        if len(missing) > 0 and not self.fetch_block_transactions(block, block_hash, missing, peer):
+            return False
+        if not self.blockchain.verify_body(block):
+            indexes = list(range(len(block.get('transactions'))))
+            if not self.fetch_block_transactions(block, block_hash, indexes, peer):
+                return False
+        return self.add_block(block, peer)
+
+    def fetch_block_transactions(self, block, block_hash, indexes, peer):
+        params = { 'hash': block_hash, 'indexes': ','.join(str(index) for index in indexes) }
+        try:
+            response = self.fanout.get(peer, '/blockchain/block/transactions', params=params)
+            if response.status_code != 200:
+                return False
+            transactions = response.json().get('transactions')
+        except Exception as e:
+            print(e)
+            return False
+        if not isinstance(transactions, list) or len(transactions) != len(indexes):
+            return False
+        for index, transaction in zip(indexes, transactions):
+            block['transactions'][index] = transaction
+        return True
+
+    # Walking back from block until reaching a block of the local block tree,
+    # returns the missing ancestors in chain order. Returns None if the walk fails
+    # or would go back more than BLOCK_TREE_MAX_FORK_DEPTH blocks
+    def fetch_missing_ancestors(self, block, peer):
+        blocks = []
+        previous_block = block
+        while previous_block.get('index') > 0 and previous_block.get('previous_block_hash') not in self.blockchain.tree:
+            if len(blocks) >= config.BLOCK_TREE_MAX_FORK_DEPTH:
+                return None
+            index = previous_block.get('index') - 1
             try:
-                response = requests.post(url=f'http://{node}/blockchain/add', json=json , timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+                response = self.fanout.get(peer, f'/blockchain/block/{index}')
+                if response.status_code != 200:
+                    return None
+                ancestor = response.json().get('block')
             except Exception as e:
                 print(e)
-
-    '''
-    def add_block(self, block):
-        return self.blockchain.add_block(block)
-
-    def broadcast_block(self, block):
-        pass
-    '''
+                return None
+            # The chain of the peer no longer holds the branch of the block
+            if self.blockchain.hash(ancestor) != previous_block.get('previous_block_hash'):
+                return None
+            blocks.append(ancestor)
+            previous_block = ancestor
+        blocks.reverse()
+        return blocks
+
+    # Gossiping to GOSSIP_FANOUT random peers, relays never wait for the peers.
+    # Peers supporting compact blocks get the compact block, peers supporting
+    # the binary encoding the encoded block and the others JSON
+    def broadcast_block(self, block, exclude=(), relay=False):
+        block_hash = self.blockchain.hash(block)
+        self.gossip.mark_seen(block_hash)
+        peers = self.gossip.select_peers(self.peers, exclude)
+        messages, compact, binary = dict(), None, None
+        for peer in peers:
+            if self.supports_compact_blocks(peer):
+                if compact is None:
+                    compact = { 'json': { 'compact_block': compact_block.create_compact_block(block, block_hash),
+                                          'peer': self.socket } }
+                messages[peer] = compact
+            elif self.supports_binary(peer):
+                if binary is None:
+                    binary = { 'data': encoding.encode_block(block), 'params': { 'peer': self.socket },
+                               'headers': { 'Content-Type': encoding.MIME_TYPE } }
+                messages[peer] = binary
+            else:
+                messages[peer] = { 'json': { 'block': block, 'peer': self.socket } }
+        self.fanout.broadcast_messages(messages, '/blockchain/block', fire_and_forget=True if relay else None)
@@ -0,0 +1,360 @@
+from argparse import ArgumentParser
+import config
+import encoding
+import heapq
+import json
+from node import Node
+import random
+import statistics
+import sys
+from time import time
+import utility
+
+
+# Discrete-event simulation of a proof-of-work network: many Node objects run
+# in one process and talk through an in-memory transport instead of HTTP.
+#   python simulator.py --nodes 20 --target-bits 10,12,14 -o results.json
+# Each node finds blocks as a Poisson process with rate hash_rate / 2^target_bits,
+# so target_bits and the hash rates set the block interval in simulated time.
+# The blocks themselves are mined for real with the SIMULATION_TARGET_BITS of
+# the nodes, which keeps them valid while the simulation runs fast.
+SIMULATION_TARGET_BITS = 4
+
+
+# Reply of the simulated transport, with the parts of requests.Response used by Node
+class SimulatedResponse(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.content = json.dumps(body).encode()
+        self.headers = { 'Content-Type': 'application/json' }
+
+    def json(self):
+        return self.body
+
+
+# Drop-in replacement of Fanout for one node: requests are handled in-process.
+# GET requests are answered right away, posted messages are delivered by the
+# network after the link delay (or dropped)
+class SimulatedFanout(object):
+    def __init__(self, network, socket):
+        self.network = network
+        self.socket = socket
+
+    def get(self, peer, path, params=None, headers=None):
+        return self.network.handle_get(peer, path, params or dict())
+
+    def post(self, peer, path, json=None, data=None, headers=None, params=None):
+        self.network.send(self.socket, peer, path, json, data, params or dict())
+        return SimulatedResponse(202, dict())
+
+    def try_post(self, peer, path, **message):
+        return self.post(peer, path, **message)
+
+    def broadcast(self, peers, path, json, fire_and_forget=None):
+        return self.broadcast_messages({ peer: { 'json': json } for peer in list(peers) }, path)
+
+    def broadcast_messages(self, messages, path, fire_and_forget=None):
+        return { peer: self.post(peer, path, **message) for peer, message in messages.items() }
+
+    # Callbacks are run by the network at the simulated time
+    def call_later(self, delay, callback):
+        self.network.schedule(delay, lambda: callback() or [])
+
+
+# In-memory transport and event loop. Subclasses can override get_link_delay
+# and is_dropped for other network models
+class SimulatedNetwork(object):
+    def __init__(self, latency, bandwidth, drop_rate, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+        self.nodes = dict()
+        self.messages = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.bytes_by_path = dict()
+
+    def connect(self, socket):
+        return SimulatedFanout(self, socket)
+
+    def add_node(self, node):
+        self.nodes[node.get_socket()] = node
+
+    def schedule(self, delay, callback):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, callback))
+
+    # Running the events up to time until (all events if None),
+    # on_event is called with the nodes touched by each event
+    def run_until(self, until=None, on_event=None):
+        while self.events and (until is None or self.events[0][0] <= until):
+            self.now, _, callback = heapq.heappop(self.events)
+            touched = callback()
+            if on_event is not None:
+                on_event(touched)
+        if until is not None:
+            self.now = until
+
+
+    # Propagation latency plus transmission time of size bytes
+    def get_link_delay(self, sender, recipient, size):
+        return self.latency + size / self.bandwidth
+
+    def is_dropped(self, sender, recipient):
+        return self.random.random() < self.drop_rate
+
+    def send(self, sender, recipient, path, json_body, data, params):
+        if recipient not in self.nodes:
+            return
+        size = len(data) if data is not None else len(json.dumps(json_body))
+        self.count(path, size)
+        if self.is_dropped(sender, recipient):
+            self.dropped += 1
+            return
+        delay = self.get_link_delay(sender, recipient, size)
+        self.schedule(delay, lambda: self.handle_post(recipient, path, json_body, data, params))
+
+    # GET requests are answered right away, only their replies are counted
+    def handle_get(self, peer, path, params):
+        response = self.get_response(peer, path, params)
+        self.count(path.rsplit('/', 1)[0] + '/<index>' if path[-1].isdigit() else path, len(response.content))
+        return response
+
+    def count(self, path, size):
+        self.messages += 1
+        self.bytes += size
+        self.bytes_by_path[path] = self.bytes_by_path.get(path, 0) + size
+
+    def get_response(self, peer, path, params):
+        node = self.nodes.get(peer)
+        if node is None:
+            raise ConnectionError(f'No simulated node {peer}')
+        if path == '/':
+            return SimulatedResponse(200, { 'wire_formats': node.get_wire_formats() })
+        if path == '/blockchain/block/transactions':
+            indexes = [int(index) for index in params.get('indexes').split(',') if index != '']
+            transactions = node.get_block_transactions_by_hash(params.get('hash'), indexes)
+            if transactions is None:
+                return SimulatedResponse(404, { 'error': 'Block or transactions not found' })
+            return SimulatedResponse(200, { 'transactions': transactions })
+        if path.startswith('/blockchain/block/'):
+            block = node.get_block(int(path.rsplit('/', 1)[1]))
+            if block is None:
+                return SimulatedResponse(404, { 'error': 'Block not found' })
+            return SimulatedResponse(200, { 'block': block })
+        return SimulatedResponse(404, { 'error': 'Not found' })
+
+    def handle_post(self, recipient, path, json_body, data, params):
+        node = self.nodes[recipient]
+        if path == '/blockchain/block':
+            if data is not None:
+                block, _ = encoding.decode_block(data)
+                node.add_block(block, params.get('peer'))
+            elif json_body.get('compact_block') is not None:
+                node.add_compact_block(json_body.get('compact_block'), json_body.get('peer'))
+            else:
+                node.add_block(json_body.get('block'), json_body.get('peer'))
+        elif path == '/transaction/add':
+            if json_body.get('transactions') is not None:
+                node.add_transactions(json_body.get('transactions'), json_body.get('peer'))
+            else:
+                node.add_transaction(json_body.get('transaction'), json_body.get('peer'))
+        elif path == '/transaction/inv':
+            node.add_inventory(json_body.get('transaction_ids'), json_body.get('peer'))
+        elif path == '/transaction/getdata':
+            node.send_transactions(json_body.get('transaction_ids'), json_body.get('peer'))
+        elif path == '/peer/add':
+            node.add_peer(json_body.get('peer'))
+        return [node]
+
+
+class Simulation(object):
+    def __init__(self, nodes, hash_rates, target_bits, peers_per_node, latency, bandwidth,
+                 drop_rate, users, transaction_rate, finality_depth, seed=None):
+        self.random = random.Random(seed)
+        self.network = SimulatedNetwork(latency, bandwidth, drop_rate, seed)
+        self.target_bits = target_bits
+        self.transaction_rate = transaction_rate
+        self.finality_depth = finality_depth
+        self.nodes = []
+        for i in range(nodes):
+            socket = f'sim:{i}'
+            node = Node(host='sim', port=i, fanout=self.network.connect(socket))
+            self.network.add_node(node)
+            self.nodes.append(node)
+        self.hash_rates = { node.get_socket(): hash_rates[i % len(hash_rates)] for i, node in enumerate(self.nodes) }
+
+        # Common genesis block, users and a random peer graph
+        genesis = self.nodes[0].get_full_chain()[0]
+        self.users = [f'user{i}' for i in range(users)]
+        for node in self.nodes:
+            node.blockchain.set_chain([genesis])
+            for user in self.users:
+                node.add_user(user, 'password')
+        sockets = [node.get_socket() for node in self.nodes]
+        for node in self.nodes:
+            others = [s for s in sockets if s != node.get_socket()]
+            for peer in self.random.sample(others, min(peers_per_node, len(others))):
+                node.add_peer(peer)
+                self.network.nodes[peer].add_peer(node.get_socket())
+
+        self.running = False
+        self.last_event_time = 0.0
+        self.mined_blocks = 0
+        self.mined_times = dict()
+        # Per node: index -> (block hash, time it became finality_depth blocks deep)
+        self.deep_blocks = { node.get_socket(): dict() for node in self.nodes }
+
+    # Time to the next block found by the node, in simulated seconds
+    def next_block_delay(self, node):
+        rate = self.hash_rates[node.get_socket()] / 2 ** self.target_bits
+        return self.random.expovariate(rate)
+
+    def schedule_mining(self, node):
+        self.network.schedule(self.next_block_delay(node), lambda: self.mine(node))
+
+    def mine(self, node):
+        if not self.running:
+            return []
+        block = node.mine(node.get_socket())
+        if block is not None:
+            self.mined_blocks += 1
+            self.mined_times[node.blockchain.get_last_block_hash()] = self.network.now
+        self.schedule_mining(node)
+        return [node]
+
+    def schedule_transaction(self):
+        self.network.schedule(self.random.expovariate(self.transaction_rate), self.create_transaction)
+
+    def create_transaction(self):
+        if not self.running:
+            return []
+        node = self.random.choice(self.nodes)
+        sender, recipient = self.random.sample(self.users, 2)
+        node.start_transaction(sender, recipient, 1)
+        self.schedule_transaction()
+        return [node]
+
+    # Recording when blocks become finality_depth blocks deep at the touched nodes
+    def track_finality(self, touched):
+        if touched:
+            self.last_event_time = self.network.now
+        for node in touched or []:
+            deep_blocks = self.deep_blocks[node.get_socket()]
+            index = len(node.get_full_chain()) - 1 - self.finality_depth
+            while index >= 0:
+                block_hash = node.blockchain.get_block_hash(index)
+                if deep_blocks.get(index, (None, ))[0] == block_hash:
+                    break
+                deep_blocks[index] = (block_hash, self.network.now)
+                index -= 1
+
+    # Mining and transactions stop after duration, then the messages in flight
+    # are delivered to measure how long the nodes take to converge
+    def run(self, duration):
+        self.running = True
+        for node in self.nodes:
+            self.schedule_mining(node)
+        if self.transaction_rate > 0:
+            self.schedule_transaction()
+        self.network.run_until(duration, self.track_finality)
+        self.running = False
+        self.network.run_until(None, self.track_finality)
+        return self.report(duration)
+
+    def report(self, duration):
+        best = max(self.nodes, key=lambda node: len(node.get_full_chain()))
+        chain = best.get_full_chain()
+        main_blocks = len(chain) - 1
+
+        finality_times = []
+        for index in range(1, len(chain)):
+            block_hash = best.blockchain.get_block_hash(index)
+            deep = [self.deep_blocks[node.get_socket()].get(index, (None, None)) for node in self.nodes]
+            if block_hash not in self.mined_times or any(h != block_hash for h, _ in deep):
+                continue
+            finality_times.append(max(t for _, t in deep) - self.mined_times[block_hash])
+
+        transactions = sum(1 for block in chain[1 : ] for transaction in block.get('transactions')
+                           if transaction.get('sender') != 'SYSTEM')
+        total_hash_rate = sum(self.hash_rates.values())
+        return {
+            'nodes': len(self.nodes),
+            'target_bits': self.target_bits,
+            'total_hash_rate': total_hash_rate,
+            'expected_block_interval': 2 ** self.target_bits / total_hash_rate,
+            'block_interval': duration / main_blocks if main_blocks > 0 else None,
+            'mined_blocks': self.mined_blocks,
+            'main_chain_blocks': main_blocks,
+            'orphan_rate': 1 - main_blocks / self.mined_blocks if self.mined_blocks > 0 else None,
+            'convergence_time': max(self.last_event_time - duration, 0),
+            'converged': all(node.blockchain.get_last_block_hash() == best.blockchain.get_last_block_hash()
+                             for node in self.nodes),
+            'finality_depth': self.finality_depth,
+            'finalized_blocks': len(finality_times),
+            'mean_time_to_finality': statistics.mean(finality_times) if finality_times else None,
+            'median_time_to_finality': statistics.median(finality_times) if finality_times else None,
+            'transactions_per_second': transactions / duration,
+            'messages': self.network.messages,
+            'dropped_messages': self.network.dropped,
+            'bytes_sent': self.network.bytes,
+            'bytes_by_path': self.network.bytes_by_path
+        }
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(',')]
+
+def parse_float_list(value):
+    return [float(v) for v in value.split(',')]
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--output', default=None, help='JSON result file (default: stdout)')
+    parser.add_argument('--nodes', default=10, type=int, help='number of nodes')
+    parser.add_argument('--hash-rates', default='1000', type=parse_float_list, help='hashes per second of each node (cycled over the nodes)')
+    parser.add_argument('--target-bits', default='12,14,16', type=parse_int_list, help='simulated difficulties, one simulation each')
+    parser.add_argument('--peers-per-node', default=4, type=int, help='random peers each node connects to')
+    parser.add_argument('--latency', default=0.1, type=float, help='link latency in seconds')
+    parser.add_argument('--bandwidth', default=1000000, type=float, help='link bandwidth in bytes per second')
+    parser.add_argument('--drop-rate', default=0.0, type=float, help='probability of dropping a message')
+    parser.add_argument('--users', default=20, type=int, help='number of users')
+    parser.add_argument('--transaction-rate', default=10, type=float, help='new transactions per simulated second')
+    parser.add_argument('--finality-depth', default=6, type=int, help='blocks on top of a block for it to be final')
+    parser.add_argument('--duration', default=600, type=float, help='simulated seconds per simulation')
+    parser.add_argument('--seed', default=None, type=int, help='random seed')
+    parser.add_argument('--compact-blocks', default=True, type=utility.str2bool, help='relay new blocks as compact blocks')
+    parser.add_argument('--inventory', default=True, type=utility.str2bool, help='announce transactions by id (inv/getdata)')
+    parser.add_argument('--inventory-window', default=config.INVENTORY_WINDOW_IN_SECONDS, type=float, help='seconds announcements are batched for')
+    args = parser.parse_args()
+
+    config.TARGET_BITS = SIMULATION_TARGET_BITS
+    config.RETARGET_INTERVAL_IN_BLOCKS = sys.maxsize
+    config.MEMPOOL_EXPIRY_IN_SECONDS = sys.maxsize
+    config.MINING_WORKERS = 1
+    config.WIRE_FORMAT_BINARY = True
+    config.COMPACT_BLOCKS = args.compact_blocks
+    config.INVENTORY_ANNOUNCEMENTS = args.inventory
+    config.INVENTORY_WINDOW_IN_SECONDS = args.inventory_window
+    results = {
+        'timestamp': int(time()),
+        'parameters': vars(args),
+        'simulations': []
+    }
+    for target_bits in args.target_bits:
+        simulation = Simulation(args.nodes, args.hash_rates, target_bits, args.peers_per_node, args.latency,
+                                args.bandwidth, args.drop_rate, args.users, args.transaction_rate,
+                                args.finality_depth, args.seed)
+        results['simulations'].append(simulation.run(args.duration))
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
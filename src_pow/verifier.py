@@ -0,0 +1,78 @@
+from concurrent.futures import ProcessPoolExecutor
+import config
+
+
+# Verifying the blocks of a shard as the blocks from index start onwards of a
+# chain, following the block hashed previous_block_hash (or previous_block,
+# hashed here if its hash is not known). targets[i] is the expected target of
+# blocks[i], block_hashes are computed here if None. check_block(block, hash,
+# target) checks a block on its own. Returns the offset of the first invalid
+# block in the shard (None if all are valid) and the block hashes
+def verify_shard(hash_block, check_block, start, previous_block_hash, previous_block, blocks, targets, block_hashes=None):
+    if previous_block is not None:
+        previous_block_hash = hash_block(previous_block)
+    if block_hashes is None:
+        block_hashes = [hash_block(block) for block in blocks]
+    for offset, (block, block_hash, target) in enumerate(zip(blocks, block_hashes, targets)):
+        if block.get('index') != start + offset or block.get('previous_block_hash') != previous_block_hash:
+            return offset, block_hashes
+        if not check_block(block, block_hash, target):
+            return offset, block_hashes
+        previous_block_hash = block_hash
+    return None, block_hashes
+
+
+# Parallel chain verification: the targets only depend on the header fields
+# and are computed beforehand, then the blocks are hashed and checked in shards
+# across a process pool. Each shard gets the hash of the block preceding it (or
+# that block itself) to check the link at its start. The shards are collected
+# in order, so the first invalid shard holds the first invalid block, and the
+# shards not started yet are cancelled. Short suffixes are verified in process
+class ChainVerifier(object):
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    # Returns the index of the first invalid block (None if all are valid)
+    # and the block hashes (None if a block is invalid)
+    def verify(self, hash_block, check_block, fork, previous_block_hash, blocks, targets, block_hashes=None):
+        if self.workers == 1 or len(blocks) < config.PARALLEL_VERIFICATION_MIN_BLOCKS:
+            offset, block_hashes = verify_shard(hash_block, check_block, fork, previous_block_hash, None,
+                                                blocks, targets, block_hashes)
+            return (None, block_hashes) if offset is None else (fork + offset, None)
+
+        executor = self.get_executor()
+        shard_size = -(-len(blocks) // (self.workers * config.VERIFIER_SHARDS_PER_WORKER))
+        shards = []
+        for start in range(0, len(blocks), shard_size):
+            end = start + shard_size
+            if start == 0:
+                previous = (previous_block_hash, None)
+            elif block_hashes is not None:
+                previous = (block_hashes[start - 1], None)
+            else:
+                previous = (None, blocks[start - 1])
+            future = executor.submit(verify_shard, hash_block, check_block, fork + start, previous[0], previous[1],
+                                     blocks[start : end], targets[start : end],
+                                     block_hashes[start : end] if block_hashes is not None else None)
+            shards.append((start, future))
+
+        hashes = []
+        for start, future in shards:
+            offset, shard_hashes = future.result()
+            if offset is not None:
+                for _, pending in shards:
+                    pending.cancel()
+                return fork + start + offset, None
+            hashes += shard_hashes
+        return None, hashes
@@ -0,0 +1,64 @@
+from argparse import ArgumentParser
+from miner import NonceHasher, decode_target
+import requests
+from time import sleep, time
+
+
+# Standalone mining worker: repeatedly gets work from a node, searches the nonce
+# range it was given and submits the nonces it finds. It needs no node of its own,
+# several workers (on any machine) can mine for the same node:
+#   python worker.py -n 127.0.0.1:5000 -u alice -p secret
+
+RETRY_DELAY_IN_SECONDS = 1
+
+REQUEST_TIMEOUT_IN_SECONDS = 10
+
+
+def get_work(node, username, password):
+    response = requests.post(url=f'http://{node}/mining/template', json={ 'username': username, 'password': password },
+                             timeout=REQUEST_TIMEOUT_IN_SECONDS)
+    response.raise_for_status()
+    return response.json()
+
+# Returns the first valid nonce of the range, None if there is none
+def search_range(work):
+    hasher = NonceHasher(work.get('header'))
+    target = decode_target(work.get('target'))
+    for nonce in range(work.get('nonce_start'), work.get('nonce_end')):
+        if hasher.hash_value(nonce) <= target:
+            return nonce
+    return None
+
+def submit(node, template_id, nonce):
+    response = requests.post(url=f'http://{node}/mining/submit', json={ 'template_id': template_id, 'nonce': nonce },
+                             timeout=REQUEST_TIMEOUT_IN_SECONDS)
+    return response.status_code == 201, response.json()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--node', default='127.0.0.1:5000', help='host:port of the node to mine for')
+    parser.add_argument('-u', '--username', required=True, help='user receiving the mining rewards')
+    parser.add_argument('-p', '--password', required=True, help='password of the user')
+    parser.add_argument('--blocks', default=0, type=int, help='stop after this many accepted blocks (0: never)')
+    args = parser.parse_args()
+
+    accepted = 0
+    while args.blocks == 0 or accepted < args.blocks:
+        try:
+            work = get_work(args.node, args.username, args.password)
+            start = time()
+            nonce = search_range(work)
+            hashes_per_second = (work.get('nonce_end') - work.get('nonce_start')) / max(time() - start, 1e-9)
+            if nonce is None:
+                print(f'No block in nonces {work.get("nonce_start")}-{work.get("nonce_end")} ({hashes_per_second:.0f} H/s)')
+                continue
+            ok, response = submit(args.node, work.get('template_id'), nonce)
+            if ok:
+                accepted += 1
+                print(f'Block {response.get("new_block").get("index")} accepted')
+            else:
+                print(f'Block rejected: {response.get("error")}')
+        except Exception as e:
+            print(e)
+            sleep(RETRY_DELAY_IN_SECONDS)
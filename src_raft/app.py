@@ -1,6 +1,9 @@
 from argparse import ArgumentParser
 import config
-from flask import Flask, jsonify, request
+import encoding
+from flask import Flask, Response, jsonify, request
+import hashlib
+import json
 from node import Node
 from raft import Raft
 import requests
@@ -19,7 +22,8 @@ app = Flask(__name__)
 def get_node_availability():
     host_port = node.get_socket()
     response = {
-        'message': f'Node on http://{host_port} is available!'
+        'message': f'Node on http://{host_port} is available!',
+        'wire_formats': node.get_wire_formats()
     }
     return jsonify(response), 200
 
@@ -58,7 +62,7 @@ def init_node_from_peer():
         return jsonify(response), 400
 
 
-# Return all node data
+# Return all node data (ETag: hash of the tip and of the other data)
 @app.route('/node/clone', methods=['GET'])
 def get_node_replica():
     host_port = node.get_socket()
@@ -66,16 +70,38 @@ def get_node_replica():
     users = node.get_users()
     transaction_pool = node.get_transaction_pool()
     user_balence_pool = node.get_user_balence_pool()
-    blockchain = node.get_full_chain()
     response = {
         'host_port': host_port,
         'peers': peers,
         'users': users,
         'transaction_pool': transaction_pool,
-        'user_balence_pool': user_balence_pool,
-        'blockchain': blockchain
+        'user_balence_pool': user_balence_pool
     }
-    return jsonify(response), 200
+    data = json.dumps(response, sort_keys=True, separators=(',', ':')).encode()
+    etag = hashlib.sha256(data).hexdigest()[ : 16]
+    # ?blockchain=false leaves the chain out, for it to be downloaded from /blockchain/chain
+    with_blockchain = utility.str2bool(request.args.get('blockchain', default='true'))
+    if with_blockchain:
+        chain, tip_hash = node.get_chain_snapshot()
+        etag = f'{tip_hash}-{etag}'
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    if with_blockchain:
+        data = b'{"blockchain":%s,%s' % (node.json_chain_cache.get_body(chain, tip_hash), data[1 : ])
+    return encoded_response(data, etag)
+
+
+# Responses holding the chain are built from the serialization cache of the node
+# and tagged with the hash of the tip, a request with a matching If-None-Match gets 304
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def encoded_response(data, etag, mimetype='application/json'):
+    response = Response(data, status=200, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
 
 
 
@@ -202,7 +228,7 @@ def get_user_balence():
         }
         return jsonify(response), 401
 
-    balence_from_blockchain = node.get_committed_user_balences().get(user)
+    balence_from_blockchain = node.get_committed_user_balence(user)
     balence_from_pool = node.get_user_balence_pool().get(user)
     response = {
         'balence_from_blockchain': balence_from_blockchain,
@@ -298,14 +324,18 @@ def post_user_transaction():
 ###################
 
 # List the full blockchain
+# (binary encoded if the Accept header prefers the binary encoding)
 @app.route('/blockchain/chain', methods=['GET'])
 def get_full_blockchain():
-    blockchain = node.get_full_chain()
-    response = {
-        'blockchain': blockchain,
-        'length': len(blockchain)
-    }
-    return jsonify(response), 200
+    chain, tip_hash = node.get_chain_snapshot()
+    binary = request.accept_mimetypes.best_match(['application/json', encoding.MIME_TYPE]) == encoding.MIME_TYPE
+    etag = f'{tip_hash}-binary' if binary else f'{tip_hash}-json'
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    if binary:
+        return encoded_response(node.binary_chain_cache.get_body(chain, tip_hash), etag, encoding.MIME_TYPE)
+    blockchain = node.json_chain_cache.get_body(chain, tip_hash)
+    return encoded_response(b'{"blockchain":%s,"length":%d}' % (blockchain, len(chain)), etag)
 
 
 # List the last adde block from blockchain
@@ -1,6 +1,7 @@
 import config
+from encoding import encode_block
 import hashlib
-import json
+import threading
 from time import time
 from uuid import uuid4
 
@@ -10,11 +11,20 @@ class Blockchain(object):
     def __init__(self, node):
         self.node = node
         self.chain = []
+        # Memoized block hashes keyed by block index, invalidated on set_chain
+        # unless the new chain extends the chain. The chain and the hashes are
+        # replaced under the lock
+        self.block_hashes = dict()
+        self.lock = threading.RLock()
+        # Account-state index: committed balences at the tip of the chain
+        self.balences = dict()
         # Raft: for uncommited changes
         self.uncommitted_user_balence_pool = dict()
         self.uncommitted_chain = None
+        self.uncommitted_chain_hashes = None
         genesis_block = self.create_new_block()
         self.chain.append(genesis_block)
+        self.apply_balences(self.balences, genesis_block)
 
 
     def get_chain(self):
@@ -24,35 +34,98 @@ class Blockchain(object):
         return self.chain[-1];
 
     def get_committed_user_balences(self):
-        return self.chain[-1].get('user_balences').copy()
-
-    def set_chain(self, chain):
-        self.chain = chain
-
-
+        return self.balences.copy()
+
+    def get_committed_user_balence(self, user):
+        return self.balences.get(user)
+
+    # balences are the committed balences at the tip of chain if already known
+    # block_hashes are the memoized hashes kept if chain extends the local chain
+    def set_chain(self, chain, chain_hashes=None, balences=None, block_hashes=None):
+        with self.lock:
+            if block_hashes is None:
+                block_hashes = dict(enumerate(chain_hashes)) if chain_hashes is not None else dict()
+            self.chain = chain
+            self.block_hashes = block_hashes
+            self.balences = balences if balences is not None else self.compute_balences(chain, len(chain) - 1)
+
+    def get_block_hash(self, index):
+        with self.lock:
+            if index < 0:
+                index += len(self.chain)
+            block_hash = self.block_hashes.get(index)
+            if block_hash is None:
+                block_hash = self.hash(self.chain[index])
+                self.block_hashes[index] = block_hash
+            return block_hash
+
+    def get_last_block_hash(self):
+        with self.lock:
+            return self.get_block_hash(len(self.chain) - 1)
+
+    # The chain and the memoized hash of its last block, as one consistent snapshot
+    def get_chain_snapshot(self):
+        with self.lock:
+            return self.chain, self.get_last_block_hash()
+
+
+    # The hash of a block is the hash of its binary encoding,
+    # None if the block cannot be encoded
     @staticmethod
-    def hash(block):        
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+    def hash(block):
+        try:
+            return hashlib.sha256(encode_block(block)).hexdigest()
+        except ValueError:
+            return None
+
+    def hash_chain(self, chain):
+        return [self.hash(block) for block in chain]
 
 
+    # Balences committed by a block: a full checkpoint every BALANCE_CHECKPOINT_INTERVAL
+    # blocks, otherwise only the changes since the previous block
     def create_new_block(self, miner=None):
         transactions = list()
         if miner is not None:
             transactions.append(self.create_mining_reward(miner))
             transactions += self.node.get_transaction_pool_as_list()
         user_balences = self.uncommitted_user_balence_pool
-        previous_block_hash = self.hash(self.get_last_block()) if len(self.chain)>0 else None
+        previous_block_hash = self.get_last_block_hash() if len(self.chain)>0 else None
 
         block = {
             'index': len(self.chain),
             'previous_block_hash': previous_block_hash,
             'timestamp': int(time()),
-            'transactions': transactions,
-            'user_balences': user_balences
+            'transactions': transactions
         }
+        if len(self.chain) % config.BALANCE_CHECKPOINT_INTERVAL == 0:
+            block['user_balences'] = user_balences
+        else:
+            block['balance_deltas'] = { user: balence - self.balences.get(user, 0)
+                                        for user, balence in user_balences.items()
+                                        if balence != self.balences.get(user) }
         return block
 
+    # Updating balences with the checkpoint or the deltas of a block
+    @staticmethod
+    def apply_balences(balences, block):
+        if block.get('user_balences') is not None:
+            balences.clear()
+            balences.update(block.get('user_balences'))
+        for user, delta in block.get('balance_deltas', dict()).items():
+            balences[user] = balences.get(user, 0) + delta
+
+    # Balences after the block at index: replaying the deltas since the last checkpoint
+    @classmethod
+    def compute_balences(cls, chain, index):
+        checkpoint = index
+        while checkpoint > 0 and chain[checkpoint].get('user_balences') is None:
+            checkpoint -= 1
+        balences = dict()
+        for i in range(max(checkpoint, 0), index + 1):
+            cls.apply_balences(balences, chain[i])
+        return balences
+
 
     # Mining a new block and committing all transactions
     def mine(self, miner):
@@ -75,13 +148,19 @@ class Blockchain(object):
 
     # A block is valid if the previous_block_hash field equals to the hash of the previous block
     def verify_block(self, block):
-        if block.get('index') == len(self.chain) and block.get('previous_block_hash') == self.hash(self.chain[-1]):
+        if block.get('index') == len(self.chain) and block.get('previous_block_hash') == self.get_last_block_hash() \
+           and self.hash(block) is not None:
             return True
         return False
 
-    def verify_chain(self, chain):
+    # Each block of the chain is hashed only once, chain_hashes can be reused by the caller
+    def verify_chain(self, chain, chain_hashes=None):
+        if chain_hashes is None:
+            chain_hashes = self.hash_chain(chain)
+        if None in chain_hashes:
+            return False
         for i in range(1, len(chain)):
-           if chain[i].get('previous_block_hash') != self.hash(chain[i-1]):
+           if chain[i].get('previous_block_hash') != chain_hashes[i-1]:
               return False
         return True;
 
@@ -93,19 +172,29 @@ class Blockchain(object):
         # Stores uncomitted changes
         if self.verify_block(last_block):
             self.uncommitted_chain = chain
+            self.uncommitted_chain_hashes = None
             return True
-        elif self.verify_chain(chain):
+        chain_hashes = self.hash_chain(chain)
+        if self.verify_chain(chain, chain_hashes):
             self.uncommitted_chain = chain
+            self.uncommitted_chain_hashes = chain_hashes
             return True
         return False
 
     # Committing all changes on blockchain and updatig all status
     def commit_chain(self):
         if self.uncommitted_user_balence_pool is not None and self.uncommitted_chain is not None:
-            self.chain = self.uncommitted_chain
+            balences, block_hashes = None, None
+            if self.uncommitted_chain_hashes is None and len(self.uncommitted_chain) == len(self.chain) + 1:
+                # The uncommitted chain extends the local chain by its last block
+                balences = self.balences.copy()
+                self.apply_balences(balences, self.uncommitted_chain[-1])
+                block_hashes = self.block_hashes
+            self.set_chain(self.uncommitted_chain, self.uncommitted_chain_hashes, balences, block_hashes)
             self.node.reset_transaction_pool()
             self.node.user_balence_pool = self.get_committed_user_balences()
             self.uncommitted_user_balence_pool = dict()
             self.uncommitted_chain = None
+            self.uncommitted_chain_hashes = None
             return True
         return False
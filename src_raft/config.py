@@ -4,8 +4,15 @@ NEW_USER_REWARD = 100
 
 MINING_REWARD = 50
 
+BALANCE_CHECKPOINT_INTERVAL = 10
+
 RAFT_ELECTION_TIMEOUT_LOWER_IN_MS = 20000
 
 RAFT_ELECTION_TIMEOUT_UPPER_IN_MS = 30000
 
 RAFT_LEADER_HEARTBEAT_INTERVAL_IN_MS = 5000
+
+# Chains are downloaded in the binary encoding from peers supporting it
+# (less than half the bytes of JSON, but slower to decode in Python than the
+# C JSON parser, so only worth it on slow links)
+WIRE_FORMAT_BINARY = False
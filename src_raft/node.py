@@ -1,5 +1,7 @@
 from blockchain import Blockchain
+import chain_cache
 import config
+import encoding
 import json
 import requests
 from time import time
@@ -13,6 +15,11 @@ class Node(object):
         self.users = dict()
         self.transaction_pool = dict()
         self.user_balence_pool = dict()
+        # Wire formats supported by each peer, as advertised by GET /
+        self.peer_wire_formats = dict()
+        # Serialization caches of the chain in JSON and in the binary encoding
+        self.json_chain_cache = chain_cache.ChainCache(chain_cache.encode_json_block, chain_cache.join_json_blocks)
+        self.binary_chain_cache = chain_cache.ChainCache(chain_cache.encode_binary_block, chain_cache.join_binary_blocks)
         self.blockchain = Blockchain(self)
         # Raft
         self.raft = None
@@ -33,18 +40,29 @@ class Node(object):
     def get_socket(self):
        return self.socket
 
-    # Initialization node by replicating from ann existing peer node
+    def get_wire_formats(self):
+        if config.WIRE_FORMAT_BINARY:
+            return [encoding.WIRE_FORMAT, 'json']
+        return ['json']
+
+    # Initialization node by replicating from ann existing peer node,
+    # the chain is downloaded separately in the binary encoding if the peer supports it
     def clone_from_peer(self, peer):
         try:
-            response = requests.get(url=f'http://{peer}/node/clone', timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+            binary = self.supports_binary(peer)
+            params = { 'blockchain': 'false' } if binary else None
+            response = requests.get(url=f'http://{peer}/node/clone', params=params, timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
             if response.status_code == 200:
-                replica = response.json()  
+                replica = response.json()
+                chain = self.get_peer_chain(peer) if binary else replica.get('blockchain')
+                if chain is None:
+                    return False
                 for p in replica.get('peers'):
                     self.add_peer(p)
                 self.users = replica.get('users')
                 self.transaction_pool = replica.get('transaction_pool')
                 self.user_balence_pool = replica.get('user_balence_pool')
-                self.blockchain.set_chain(replica.get('blockchain'))
+                self.blockchain.set_chain(chain)
                 return True
         except Exception as e:
             print(e)
@@ -63,6 +81,7 @@ class Node(object):
             try:
                 response = requests.get(url=f'http://{peer}/', timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
                 if response.status_code == 200:
+                    self.peer_wire_formats[peer] = response.json().get('wire_formats', ['json'])
                     self.broadcast_peer(peer)
                     self.peers.add(peer)
                     return True
@@ -70,6 +89,33 @@ class Node(object):
                 print(e)
         return False
 
+    # The wire formats of a peer are asked for once, a peer that cannot be
+    # reached is assumed to support JSON only until asked again
+    def supports_binary(self, peer):
+        if not config.WIRE_FORMAT_BINARY:
+            return False
+        if peer not in self.peer_wire_formats:
+            try:
+                response = requests.get(url=f'http://{peer}/', timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+                if response.status_code != 200:
+                    return False
+                self.peer_wire_formats[peer] = response.json().get('wire_formats', ['json'])
+            except Exception as e:
+                print(e)
+                return False
+        return encoding.WIRE_FORMAT in self.peer_wire_formats[peer]
+
+    # Downloading the binary encoded chain of a peer
+    def get_peer_chain(self, peer):
+        try:
+            response = requests.get(url=f'http://{peer}/blockchain/chain', headers={ 'Accept': encoding.MIME_TYPE },
+                                    timeout=config.CONNECTION_TIMEOUT_IN_SECONDS)
+            if response.status_code == 200 and response.headers.get('Content-Type') == encoding.MIME_TYPE:
+                return encoding.decode_blocks(response.content)
+        except Exception as e:
+            print(e)
+        return None
+
     def add_peer(self, peer):
         if peer!=self.socket:
             self.peers.add(peer)
@@ -202,12 +248,19 @@ class Node(object):
     def get_full_chain(self):
         return self.blockchain.get_chain()
 
+    # The chain and the hash of its last block, as one consistent snapshot
+    def get_chain_snapshot(self):
+        return self.blockchain.get_chain_snapshot()
+
     def get_last_block(self):
         return self.blockchain.get_last_block()
 
     def get_committed_user_balences(self):
         return self.blockchain.get_committed_user_balences()
 
+    def get_committed_user_balence(self, user):
+        return self.blockchain.get_committed_user_balence(user)
+
     def mine(self, miner):
         new_block = self.blockchain.mine(miner)
         if new_block is not None: